@@ -0,0 +1,531 @@
+"""Micro-benchmarks for the data pipeline and training loop.
+
+Usage:
+    python benchmark.py startup --dataset cifar10 --ratio 100
+    python benchmark.py loader --dataset cifar100 --mode over
+    python benchmark.py attack --batch-size 64 --compile
+    python benchmark.py precision --dataset cifar10 --epochs 10
+    python benchmark.py eval --n_images 10000
+"""
+
+import argparse
+import contextlib
+import time
+from functools import partial
+
+import models
+import numpy as np
+import torch
+import torch.nn as nn
+import torchvision.transforms as transforms
+from data_loader import (
+    DATA_ROOT,
+    get_imbalanced,
+    get_imbalanced_data,
+    get_oversampled,
+    get_oversampled_data,
+    get_smote,
+    get_val_test_data,
+    make_longtailed_imb,
+    num_test_samples_cifar10,
+    num_test_samples_cifar100,
+)
+from metrics import StreamingMetrics
+from torchvision import datasets
+from utils import InputNormalize, dual_forward, dual_input_grad, sum_t
+
+
+def _legacy_val_test_data(dataset, num_sample_per_class):
+    num_sample_per_class = list(num_sample_per_class)
+    num_samples = num_sample_per_class[0]
+    val_list, test_list = [], []
+    for index in range(len(dataset)):
+        _, label = dataset.__getitem__(index)
+        if num_sample_per_class[label] > (9 * num_samples / 10):
+            val_list.append(index)
+        else:
+            test_list.append(index)
+        num_sample_per_class[label] -= 1
+    return val_list, test_list
+
+
+def _legacy_imbalanced_data(dataset, num_sample_per_class):
+    num_sample_per_class = list(num_sample_per_class)
+    selected_list = []
+    for index in range(len(dataset)):
+        _, label = dataset.__getitem__(index)
+        if num_sample_per_class[label] > 0:
+            selected_list.append(index)
+            num_sample_per_class[label] -= 1
+    return selected_list
+
+
+def _legacy_oversampled_data(dataset, num_sample_per_class):
+    num_sample_per_class = list(num_sample_per_class)
+    num_samples = list(num_sample_per_class)
+    selected_list = []
+    for index in range(len(dataset)):
+        _, label = dataset.__getitem__(index)
+        if num_sample_per_class[label] > 0:
+            selected_list.append(1 / num_samples[label])
+            num_sample_per_class[label] -= 1
+    return selected_list
+
+
+def _timeit(fn, *args):
+    start = time.perf_counter()
+    out = fn(*args)
+    return out, time.perf_counter() - start
+
+
+def bench_startup(args):
+    """Split construction time with per-image decoding vs. the label index."""
+    if args.dataset == "cifar10":
+        dataset_, n_class, num_test = datasets.CIFAR10, 10, num_test_samples_cifar10
+    else:
+        dataset_, n_class, num_test = datasets.CIFAR100, 100, num_test_samples_cifar100
+
+    transform_train = transforms.Compose(
+        [
+            transforms.RandomCrop(32, padding=4),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+        ]
+    )
+    transform_test = transforms.Compose([transforms.ToTensor()])
+    train_set = dataset_(DATA_ROOT, True, transform=transform_train, download=True)
+    test_set = dataset_(DATA_ROOT, False, transform=transform_test, download=True)
+    counts = make_longtailed_imb(args.n_samples, n_class, args.ratio)
+
+    cases = [
+        ("imbalanced", _legacy_imbalanced_data, get_imbalanced_data, train_set),
+        ("oversampled", _legacy_oversampled_data, get_oversampled_data, train_set),
+        ("val/test", _legacy_val_test_data, get_val_test_data, test_set),
+    ]
+    header = ("split", "before (s)", "after (s)", "speedup", "same")
+    print("%-12s %12s %12s %9s  %s" % header)
+    total_before, total_after = 0.0, 0.0
+    for name, legacy, fast, dataset in cases:
+        num = num_test if dataset is test_set else counts
+        ref, t_before = _timeit(legacy, dataset, num)
+        out, t_after = _timeit(fast, dataset, num)
+        total_before += t_before
+        total_after += t_after
+        print(
+            "%-12s %12.3f %12.4f %8.0fx  %s"
+            % (name, t_before, t_after, t_before / t_after, ref == out)
+        )
+    print(
+        "%-12s %12.3f %12.4f %8.0fx"
+        % ("total", total_before, total_after, total_before / total_after)
+    )
+
+
+def _images_per_sec(loader, device, n_batches):
+    n_images, start = 0, None
+    for i, (inputs, targets) in enumerate(loader):
+        inputs, targets = inputs.to(device), targets.to(device)
+        if i == 0:
+            # Exclude worker start-up and the first (warm-up) batch
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            continue
+        n_images += inputs.size(0)
+        if i == n_batches:
+            break
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return n_images / (time.perf_counter() - start)
+
+
+def bench_loader(args):
+    """Training images/sec of the worker DataLoaders vs. DeviceLoader."""
+    device = torch.device(args.device)
+    n_class = 10 if args.dataset == "cifar10" else 100
+    counts = make_longtailed_imb(args.n_samples, n_class, args.ratio)
+    build = {"subset": get_imbalanced, "over": get_oversampled, "smote": get_smote}
+    build = build[args.mode]
+
+    transform_train = transforms.Compose(
+        [
+            transforms.RandomCrop(32, padding=4),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+        ]
+    )
+    transform_test = transforms.Compose([transforms.ToTensor()])
+
+    print("%-14s %12s" % ("loader", "images/sec"))
+    for name, train_device in [("DataLoader", None), ("DeviceLoader", device)]:
+        loader, _, _ = build(
+            args.dataset,
+            counts,
+            args.batch_size,
+            transform_train,
+            transform_test,
+            device=train_device,
+        )
+        n_batches = min(args.n_batches, len(loader) - 1)
+        speed = _images_per_sec(loader, device, n_batches)
+        print("%-14s %12.0f" % (name, speed))
+
+
+def _classwise_loss(outputs, targets):
+    # Same as classwise_loss in train.py
+    out_1hot = torch.zeros_like(outputs)
+    out_1hot.scatter_(1, targets.view(-1, 1), 1)
+    return (outputs * out_1hot).sum(1).mean()
+
+
+def _legacy_attack_grad(model_g, model_r, normalize, x, targets, seed_targets, lam):
+    criterion = nn.CrossEntropyLoss()
+    x = x.clone().detach().requires_grad_(True)
+    outputs_g, _ = model_g(normalize(x))
+    outputs_r, _ = model_r(normalize(x))
+    loss = criterion(outputs_g, targets)
+    loss = loss + lam * _classwise_loss(outputs_r, seed_targets)
+    (grad,) = torch.autograd.grad(loss, [x])
+    return grad
+
+
+def _dual_attack_grad(
+    model_g, model_r, normalize, x, targets, seed_targets, lam, criterion, stream
+):
+    outputs_g, outputs_r, x_g, x_r = dual_forward(
+        model_g, model_r, normalize, x, stream
+    )
+    loss = criterion(outputs_g, targets)
+    loss = loss + lam * _classwise_loss(outputs_r, seed_targets)
+    return dual_input_grad(loss, x_g, x_r, normalize)
+
+
+def _steps_per_sec(step, device, n_steps):
+    step()  # warm-up ( and compilation )
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return n_steps / (time.perf_counter() - start)
+
+
+def bench_attack(args):
+    """Attack steps/sec of generation() before and after the dual-network step."""
+    device = torch.device(args.device)
+    n_class = 10 if args.dataset == "cifar10" else 100
+    model_g = models.__dict__[args.model](n_class).to(device).eval()
+    model_r = models.__dict__[args.model](n_class).to(device).eval()
+    normalize = InputNormalize(*MEAN_STD[args.dataset]).to(device)
+
+    x = torch.rand(args.batch_size, 3, 32, 32, device=device)
+    targets = torch.randint(n_class, (args.batch_size,), device=device)
+    seed_targets = torch.randint(n_class, (args.batch_size,), device=device)
+    criterion = nn.CrossEntropyLoss()
+    stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+
+    batch = (normalize, x, targets, seed_targets, args.lam)
+    cases = [
+        ("legacy", partial(_legacy_attack_grad, model_g, model_r, *batch)),
+        (
+            "dual",
+            partial(_dual_attack_grad, model_g, model_r, *batch, criterion, stream),
+        ),
+    ]
+    if args.compile:
+        mode = "reduce-overhead" if device.type == "cuda" else None
+        compiled_g = torch.compile(model_g, mode=mode)
+        compiled_r = torch.compile(model_r, mode=mode)
+        step = partial(
+            _dual_attack_grad, compiled_g, compiled_r, *batch, criterion, stream
+        )
+        cases.append(("dual+compile", step))
+
+    ref = cases[0][1]()
+    print("%-14s %12s  %s" % ("attack step", "steps/sec", "same grad"))
+    for name, step in cases:
+        same = torch.equal(ref, step())
+        speed = _steps_per_sec(step, device, args.n_steps)
+        print("%-14s %12.1f  %s" % (name, speed, same))
+
+
+def _autocast(device, dtype):
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device.type, dtype=dtype)
+
+
+def _balanced_accuracy(model, normalize, loader, device, dtype, n_class):
+    model.eval()
+    confusion = torch.zeros(n_class * n_class, dtype=torch.long, device=device)
+    with torch.no_grad(), _autocast(device, dtype):
+        for inputs, targets in loader:
+            inputs, targets = inputs.to(device), targets.to(device)
+            predicted = model(normalize(inputs))[0].argmax(1)
+            confusion += torch.bincount(
+                targets * n_class + predicted, minlength=n_class * n_class
+            )
+    confusion = confusion.view(n_class, n_class).double()
+    return (confusion.diag() / confusion.sum(1)).mean().item()
+
+
+def bench_precision(args):
+    """Training images/sec and final test balanced accuracy per --precision."""
+    device = torch.device(args.device)
+    n_class = 10 if args.dataset == "cifar10" else 100
+    counts = make_longtailed_imb(args.n_samples, n_class, args.ratio)
+    transform_test = transforms.Compose([transforms.ToTensor()])
+    # The device loader augments the training batches itself
+    train_loader, _, test_loader = get_imbalanced(
+        args.dataset,
+        counts,
+        args.batch_size,
+        transform_test,
+        transform_test,
+        device=device,
+    )
+    normalize = InputNormalize(*MEAN_STD[args.dataset]).to(device)
+
+    modes = [("fp32", None), ("bf16", torch.bfloat16)]
+    if device.type == "cuda":
+        modes.append(("fp16", torch.float16))
+
+    print("%-6s %12s %14s" % ("mode", "images/sec", "test bal acc"))
+    for name, dtype in modes:
+        torch.manual_seed(0)
+        model = models.__dict__[args.model](n_class).to(device)
+        optimizer = torch.optim.SGD(
+            model.parameters(), lr=args.lr, momentum=0.9, weight_decay=2e-4
+        )
+        scaler = torch.cuda.amp.GradScaler(enabled=dtype == torch.float16)
+
+        n_images, elapsed = 0, 0.0
+        for _ in range(args.epochs):
+            model.train()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            for inputs, targets in train_loader:
+                inputs, targets = inputs.to(device), targets.to(device)
+                with _autocast(device, dtype):
+                    outputs, _ = model(normalize(inputs))
+                loss = nn.functional.cross_entropy(outputs.float(), targets)
+                optimizer.zero_grad()
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+                n_images += inputs.size(0)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            elapsed += time.perf_counter() - start
+
+        bal_acc = _balanced_accuracy(
+            model, normalize, test_loader, device, dtype, n_class
+        )
+        print("%-6s %12.0f %13.2f%%" % (name, n_images / elapsed, 100.0 * bal_acc))
+
+
+def _legacy_eval(model, batches, n_class):
+    # evaluate() with per-class counters and a sync per counter and batch
+    criterion = nn.CrossEntropyLoss()
+    total_loss, correct, total = 0.0, 0, 0
+    class_correct = torch.zeros(n_class)
+    class_total = torch.zeros(n_class)
+    with torch.no_grad():
+        for inputs, targets in batches:
+            outputs, _ = model(inputs)
+            total_loss += criterion(outputs, targets).item() * inputs.size(0)
+            correct_mask = outputs.max(1)[1] == targets
+            correct += sum_t(correct_mask)
+            total += targets.size(0)
+            for i in range(n_class):
+                class_mask = targets == i
+                class_total[i] += sum_t(class_mask)
+                class_correct[i] += sum_t(correct_mask * class_mask)
+    return 100.0 * class_correct / class_total
+
+
+def _confusion_eval(model, batches, n_class, device):
+    criterion = nn.CrossEntropyLoss()
+    metrics = StreamingMetrics(n_class)
+    with torch.no_grad():
+        for inputs, targets in batches:
+            outputs, _ = model(inputs)
+            metrics.update(outputs, targets, criterion(outputs, targets))
+    return metrics.compute()["class_acc"]
+
+
+def bench_eval(args):
+    """Evaluation wall time with per-class counters vs. a confusion matrix."""
+    device = torch.device(args.device)
+    header = ("classes", "before (s)", "after (s)", "speedup", "same")
+    print("%-8s %12s %12s %9s  %s" % header)
+    for n_class in [10, 100]:
+        torch.manual_seed(0)
+        model = models.__dict__[args.model](n_class).to(device).eval()
+        batches = [
+            (
+                torch.randn(args.batch_size, 3, 32, 32, device=device),
+                torch.randint(n_class, (args.batch_size,), device=device),
+            )
+            for _ in range(args.n_images // args.batch_size)
+        ]
+        _confusion_eval(model, batches[:1], n_class, device)  # warm-up
+
+        ref, t_before = _timeit(_legacy_eval, model, batches, n_class)
+        out, t_after = _timeit(_confusion_eval, model, batches, n_class, device)
+        same = torch.allclose(ref, out, equal_nan=True)
+        print(
+            "%-8d %12.3f %12.3f %8.1fx  %s"
+            % (n_class, t_before, t_after, t_before / t_after, same)
+        )
+
+
+def _sgd_step(model, optimizer, inputs, targets):
+    """One SGD step; (N, K) targets go with a BatchedCifarResNet."""
+    outputs, _ = model(inputs)
+    if targets.dim() == 1:
+        loss = nn.functional.cross_entropy(outputs, targets)
+    else:
+        loss = sum(
+            nn.functional.cross_entropy(outputs[:, k], targets[:, k])
+            for k in range(targets.size(1))
+        )
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+    return outputs
+
+
+def bench_batched(args):
+    """Training images/sec of K separate models vs. one BatchedCifarResNet."""
+    device = torch.device(args.device)
+    n_class = 10 if args.dataset == "cifar10" else 100
+    header = ("models", "separate", "batched", "speedup", "same logits")
+    print("%-7s %12s %12s %9s  %s" % header)
+    for n_models in args.n_models:
+        nets = []
+        for seed in range(n_models):
+            torch.manual_seed(seed)
+            nets.append(models.__dict__[args.model](n_class).to(device))
+        batched = models.BatchedCifarResNet(nets).to(device)
+        inputs = torch.randn(args.batch_size, n_models, 3, 32, 32, device=device)
+        targets = torch.randint(n_class, (args.batch_size, n_models), device=device)
+
+        steps = []
+        for k, net in enumerate(nets):
+            optimizer = torch.optim.SGD(net.parameters(), lr=0.1, momentum=0.9)
+            batch = (inputs[:, k], targets[:, k])
+            steps.append(partial(_sgd_step, net, optimizer, *batch))
+        optimizer = torch.optim.SGD(batched.parameters(), lr=0.1, momentum=0.9)
+        fused = partial(_sgd_step, batched, optimizer, inputs, targets)
+
+        # One step of each from the same weights, then compare the next logits
+        for step in steps:
+            step()
+        fused()
+        with torch.no_grad():
+            ref = torch.stack([net(inputs[:, k])[0] for k, net in enumerate(nets)], 1)
+            out = batched(inputs)[0]
+        same = torch.allclose(ref, out, rtol=1e-3, atol=1e-4)
+
+        separate = _steps_per_sec(lambda: [step() for step in steps], device, 20)
+        together = _steps_per_sec(fused, device, 20)
+        images = args.batch_size * n_models
+        speedup = together / separate
+        print(
+            "%-7d %12.1f %12.1f %8.1fx  %s"
+            % (n_models, separate * images, together * images, speedup, same)
+        )
+
+
+DATASETS = ["cifar10", "cifar100"]
+MEAN_STD = {
+    "cifar10": (
+        torch.tensor([0.4914, 0.4822, 0.4465]),
+        torch.tensor([0.2023, 0.1994, 0.2010]),
+    ),
+    "cifar100": (
+        torch.tensor([0.5071, 0.4867, 0.4408]),
+        torch.tensor([0.2675, 0.2565, 0.2761]),
+    ),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="M2m benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    startup = sub.add_parser("startup", help="imbalanced/val/test split construction")
+    startup.add_argument("--dataset", default="cifar10", choices=DATASETS)
+    startup.add_argument("--ratio", default=100, type=int, help="max/min")
+    startup.add_argument("--n_samples", default=5000, type=int, help="max class size")
+    startup.set_defaults(func=bench_startup)
+
+    loader = sub.add_parser("loader", help="training input pipeline throughput")
+    loader.add_argument("--dataset", default="cifar10", choices=DATASETS)
+    loader.add_argument("--ratio", default=100, type=int, help="max/min")
+    loader.add_argument("--n_samples", default=5000, type=int, help="max class size")
+    loader.add_argument("--mode", default="subset", choices=["subset", "over", "smote"])
+    loader.add_argument("--batch-size", default=128, type=int, help="batch size")
+    loader.add_argument("--n_batches", default=200, type=int, help="timed batches")
+    loader.add_argument(
+        "--device", default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    loader.set_defaults(func=bench_loader)
+
+    attack = sub.add_parser("attack", help="M2m attack step of generation()")
+    attack.add_argument("--dataset", default="cifar10", choices=DATASETS)
+    attack.add_argument("--model", default="resnet32", type=str)
+    attack.add_argument("--batch-size", default=64, type=int, help="seeds per step")
+    attack.add_argument("--lam", default=0.5, type=float)
+    attack.add_argument("--n_steps", default=100, type=int, help="timed steps")
+    attack.add_argument("--compile", action="store_true", help="also torch.compile")
+    attack.add_argument(
+        "--device", default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    attack.set_defaults(func=bench_attack)
+
+    precision = sub.add_parser("precision", help="fp32 / bf16 / fp16 training")
+    precision.add_argument("--dataset", default="cifar10", choices=DATASETS)
+    precision.add_argument("--ratio", default=100, type=int, help="max/min")
+    precision.add_argument("--n_samples", default=5000, type=int, help="max class size")
+    precision.add_argument("--model", default="resnet32", type=str)
+    precision.add_argument("--batch-size", default=128, type=int, help="batch size")
+    precision.add_argument("--lr", default=0.1, type=float, help="learning rate")
+    precision.add_argument("--epochs", default=10, type=int, help="epochs per mode")
+    precision.add_argument(
+        "--device", default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    precision.set_defaults(func=bench_precision)
+
+    evaluation = sub.add_parser("eval", help="evaluate() metric accumulation")
+    evaluation.add_argument("--model", default="resnet32", type=str)
+    evaluation.add_argument("--batch-size", default=100, type=int, help="batch size")
+    evaluation.add_argument("--n_images", default=10000, type=int, help="test size")
+    evaluation.add_argument(
+        "--device", default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    evaluation.set_defaults(func=bench_eval)
+
+    batched = sub.add_parser("batched", help="train_batch.py's fused models")
+    batched.add_argument("--dataset", default="cifar10", choices=DATASETS)
+    batched.add_argument("--model", default="resnet32", type=str)
+    batched.add_argument("--batch-size", default=128, type=int, help="batch size")
+    batched.add_argument(
+        "--n_models", default=[1, 2, 4, 8], type=int, nargs="+", help="K to time"
+    )
+    batched.add_argument(
+        "--device", default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    batched.set_defaults(func=bench_batched)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    np.random.seed(0)
+    args = parse_args()
+    args.func(args)
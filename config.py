@@ -1,4 +1,7 @@
 import argparse
+import contextlib
+import csv
+import os
 
 import matplotlib.pyplot as plt
 import models
@@ -7,16 +10,27 @@ import pandas as pd
 import torch
 import torch.backends.cudnn as cudnn
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision.transforms as transforms
 import wandb
-from data_loader import get_imbalanced, get_oversampled, get_smote, make_longtailed_imb
+from data_loader import (
+    get_cache_key,
+    get_class_draws,
+    get_imbalanced,
+    get_oversampled,
+    get_smote,
+    get_train_images,
+    load_cifar_lt,
+    make_longtailed_imb,
+)
 from imblearn.metrics import geometric_mean_score
 from matplotlib.colors import ListedColormap
+from metrics import StreamingMetrics, get_class_groups, get_shot_groups
 from scipy.stats import gmean
 from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
 from sklearn.metrics import balanced_accuracy_score, precision_score, recall_score
-from utils import InputNormalize, sum_t
+from utils import FocalLoss, InputNormalize, LDAMLoss, sum_t
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 cudnn.benchmark = True
@@ -101,6 +115,119 @@ def parse_args():
     parser.add_argument("--gen", "-gen", action="store_true", help="")
     parser.add_argument("--step_size", default=0.1, type=float, help="")
     parser.add_argument("--attack_iter", default=10, type=int, help="")
+    parser.add_argument(
+        "--async_gen",
+        action="store_true",
+        help="Generate the next batch in the background while training",
+    )
+    parser.add_argument(
+        "--gen_staleness",
+        default=1,
+        type=int,
+        help="Refresh the generation copy of net_t every N batches (--async_gen)",
+    )
+    parser.add_argument(
+        "--gen_device",
+        default=None,
+        type=str,
+        help="Device for --async_gen generation, e.g. cuda:1 (default: training)",
+    )
+    parser.add_argument(
+        "--warm_start",
+        action="store_true",
+        help="Start attacks from the last translation of the same seed and target",
+    )
+    parser.add_argument(
+        "--warm_iter",
+        default=2,
+        type=int,
+        help="Refinement steps for warm-started translations",
+    )
+    parser.add_argument(
+        "--warm_store_size",
+        default=100000,
+        type=int,
+        help="Maximum number of stored translations (LRU eviction)",
+    )
+    parser.add_argument(
+        "--warm_store_dtype",
+        default="uint8",
+        choices=["uint8", "half"],
+        help="Storage precision of the stored translations",
+    )
+    parser.add_argument(
+        "--early_exit",
+        action="store_true",
+        help="Stop attacking samples once their g-confidence reaches gamma",
+    )
+    parser.add_argument(
+        "--adaptive_budget",
+        action="store_true",
+        help="Adapt attack steps, step size and attempts per class to acceptance",
+    )
+    parser.add_argument(
+        "--budget_min_tries",
+        default=50,
+        type=int,
+        help="Attacks before a (target, seed) class pair with no success is dropped",
+    )
+    parser.add_argument(
+        "--budget_max_attempts",
+        default=3,
+        type=int,
+        help="Maximum seeds attacked per generation slot with --adaptive_budget",
+    )
+    parser.add_argument(
+        "--gen_chunk",
+        default=0,
+        type=int,
+        help="Generate per-class epoch quotas in chunks of N requests (0: per batch)",
+    )
+    parser.add_argument(
+        "--gen_quota_scale",
+        default=1.0,
+        type=float,
+        help="Scale --gen_chunk quotas by up to this factor by the acceptance "
+        "rate of each class, to fill every slot ( 1: one attempt per slot )",
+    )
+    parser.add_argument(
+        "--gen_compile",
+        action="store_true",
+        help="torch.compile the attack step ( CUDA graphs on CUDA )",
+    )
+    parser.add_argument(
+        "--seed_index",
+        action="store_true",
+        help="Draw seeds from the training set ranked by net_g for each target",
+    )
+    parser.add_argument(
+        "--seed_topk",
+        default=100,
+        type=int,
+        help="Top-ranked seeds kept per (seed class, target class) pair",
+    )
+    parser.add_argument(
+        "--export_gen",
+        action="store_true",
+        help="Translate the training set once with net_g into --gen_store and exit",
+    )
+    parser.add_argument(
+        "--export_epochs",
+        default=1,
+        type=int,
+        help="Passes over the training set for --export_gen",
+    )
+    parser.add_argument(
+        "--offline_gen",
+        action="store_true",
+        help="Draw generated samples from --gen_store instead of attacking online",
+    )
+    parser.add_argument(
+        "--gen_store",
+        default="./gen_store",
+        type=str,
+        help="Root directory of exported translations",
+    )
 
     parser.add_argument(
         "--imb_type",
@@ -122,20 +249,76 @@ def parse_args():
     )
 
     parser.add_argument("--smote", "-s", action="store_true", help="oversampling")
+    parser.add_argument(
+        "--lazy_smote",
+        action="store_true",
+        help="Synthesize SMOTE samples on the fly with a new lambda every epoch",
+    )
+    parser.add_argument(
+        "--smote_legacy_distance",
+        action="store_true",
+        help="SMOTE neighbours from uint8 distances that wrap around, "
+        "as before ( slow; only to reproduce older SMOTE results )",
+    )
     parser.add_argument("--cost", "-c", action="store_true", help="oversampling")
     parser.add_argument(
         "--effect_over",
         action="store_true",
         help="Use effective number in oversampling",
     )
+    parser.add_argument(
+        "--class_aware",
+        action="store_true",
+        help="Over-sample with the class-aware sampler ( class, then index )",
+    )
     parser.add_argument(
         "--no_over", dest="over", action="store_false", help="Do not use over-sampling"
     )
     parser.add_argument(
         "--n_samples", default=500, type=int, help="dataset sample size"
     )
+    parser.add_argument(
+        "--device_data",
+        action="store_true",
+        help="Keep the training set on the device and augment whole batches",
+    )
+    parser.add_argument(
+        "--cached_eval",
+        action="store_true",
+        help="Score val and test from one forward pass over a cached test tensor",
+    )
+    parser.add_argument(
+        "--no_cache",
+        dest="cache",
+        action="store_false",
+        help="Do not use the on-disk cache of long-tailed splits",
+    )
 
     parser.add_argument("--gen_prob", default=0.5, type=float, help="generation prob")
+    parser.add_argument(
+        "--embed_every",
+        default=0,
+        type=int,
+        help="Plot a 2-D embedding of training samples every N epochs (0: never)",
+    )
+    parser.add_argument(
+        "--embed_method",
+        default="pca",
+        choices=["pca", "tsne"],
+        help="Projection of the embedding snapshots",
+    )
+    parser.add_argument(
+        "--embed_source",
+        default="logits",
+        choices=["logits", "features"],
+        help="Embed the logits or the penultimate features",
+    )
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        choices=["fp32", "fp16", "bf16"],
+        help="Autocast precision of training, generation and evaluation",
+    )
     return parser.parse_args()
 
 
@@ -164,12 +347,17 @@ LR = ARGS.lr
 EPOCH = ARGS.epoch
 START_EPOCH = 0
 
-LOGFILE_BASE = (
-    f"S{SEED}_{ARGS.name}_"
-    f"L{ARGS.lam}_W{ARGS.warm}_"
-    f"E{ARGS.step_size}_I{ARGS.attack_iter}_"
-    f"{DATASET}_R{ARGS.ratio}_{MODEL}_G{ARGS.gamma}_B{ARGS.beta}"
-)
+
+def get_logfile_base(seed):
+    return (
+        f"S{seed}_{ARGS.name}_"
+        f"L{ARGS.lam}_W{ARGS.warm}_"
+        f"E{ARGS.step_size}_I{ARGS.attack_iter}_"
+        f"{DATASET}_R{ARGS.ratio}_{MODEL}_G{ARGS.gamma}_B{ARGS.beta}"
+    )
+
+
+LOGFILE_BASE = get_logfile_base(SEED)
 
 # Data
 print("==> Preparing data: %s" % DATASET)
@@ -189,6 +377,23 @@ else:
 
 normalizer = InputNormalize(mean, std).to(device)
 
+## Precision ##
+
+AMP_DTYPE = {"fp32": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+AMP_DTYPE = AMP_DTYPE[ARGS.precision]
+if AMP_DTYPE == torch.float16 and device.type != "cuda":
+    raise ValueError("--precision fp16 needs CUDA, use bf16 on CPU")
+# Loss scaling is only needed for fp16; disabled, it is a pass-through
+SCALER = torch.cuda.amp.GradScaler(enabled=AMP_DTYPE == torch.float16)
+
+
+def autocast(device_type=None):
+    """Autocast context of --precision ( a no-op for fp32 )."""
+    if AMP_DTYPE is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type or device.type, dtype=AMP_DTYPE)
+
+
 if "cifar" in DATASET:
     if ARGS.augment:
         transform_train = transforms.Compose(
@@ -230,8 +435,25 @@ df = pd.DataFrame(
 wandb.log({"N_SAMPLES_PER_CLASS_BASE": wandb.Table(dataframe=df)})
 print(N_SAMPLES_PER_CLASS_BASE)
 
+if ARGS.cache:
+    CACHE_KEY = get_cache_key(
+        DATASET, ARGS.ratio, N_SAMPLES, ARGS.imb_type, ARGS.imb_start
+    )
+else:
+    CACHE_KEY = None
+
+TRAIN_DATA_DEVICE = device if ARGS.device_data else None
+
 train_loader, val_loader, test_loader = get_imbalanced(
-    DATASET, N_SAMPLES_PER_CLASS_BASE, BATCH_SIZE, transform_train, transform_test
+    DATASET,
+    N_SAMPLES_PER_CLASS_BASE,
+    BATCH_SIZE,
+    transform_train,
+    transform_test,
+    cache_key=CACHE_KEY,
+    device=TRAIN_DATA_DEVICE,
+    augment=ARGS.augment,
+    return_index=ARGS.gen and ARGS.warm_start,
 )
 
 ## To apply effective number for over-sampling or cost-sensitive ##
@@ -262,6 +484,92 @@ def adjust_learning_rate(optimizer, lr_init, epoch):
         param_group["lr"] = lr
 
 
+def get_criterion(epoch, eff_beta=None):
+    """
+    Loss of --loss_type at `epoch`, with the class-balanced weights of
+    --eff_beta ( or `eff_beta` ) once --cost is on and the warm-up is over.
+    """
+    ## For Cost-Sensitive Learning ##
+
+    if ARGS.cost and epoch >= ARGS.warm:
+        beta = ARGS.eff_beta if eff_beta is None else eff_beta
+        if beta < 1:
+            effective_num = 1.0 - np.power(beta, N_SAMPLES_PER_CLASS)
+            per_cls_weights = (1.0 - beta) / np.array(effective_num)
+        else:
+            per_cls_weights = 1 / np.array(N_SAMPLES_PER_CLASS)
+        per_cls_weights = (
+            per_cls_weights / np.sum(per_cls_weights) * len(N_SAMPLES_PER_CLASS)
+        )
+        per_cls_weights = torch.FloatTensor(per_cls_weights).to(device)
+    else:
+        per_cls_weights = torch.ones(N_CLASSES).to(device)
+
+    ## Choos a loss function ##
+
+    if ARGS.loss_type == "CE":
+        criterion = nn.CrossEntropyLoss(weight=per_cls_weights, reduction="none").to(
+            device
+        )
+    elif ARGS.loss_type == "Focal":
+        criterion = FocalLoss(
+            weight=per_cls_weights, gamma=ARGS.focal_gamma, reduction="none"
+        ).to(device)
+    elif ARGS.loss_type == "LDAM":
+        criterion = LDAMLoss(
+            cls_num_list=N_SAMPLES_PER_CLASS,
+            max_m=0.5,
+            s=30,
+            weight=per_cls_weights,
+            reduction="none",
+        ).to(device)
+    else:
+        raise ValueError("Wrong Loss Type")
+
+    return criterion
+
+
+# Classes of each group reported by the evaluation ( "<name>_acc" ): the
+# major / neutral / minor thirds and the many / medium / few-shot classes
+CLASS_GROUPS = dict(
+    get_class_groups(N_CLASSES), **get_shot_groups(N_SAMPLES_PER_CLASS_BASE)
+)
+
+
+def get_eval_results(metrics, logger=None):
+    """
+    Compute the evaluation metrics of a split from its StreamingMetrics.
+    Pass logger=False to skip logging them.
+    """
+    results = metrics.compute()
+    results["test_bal_acc"], results["test_gm"] = results["bal_acc"], results["gm"]
+
+    if logger is not False:
+        log_eval_results(results, logger)
+
+    return results
+
+
+def log_eval_results(results, logger=None):
+    msg = "Loss: %.3f | Acc: %.3f%% (%d/%d)" % (
+        results["loss"],
+        results["acc"],
+        results["correct"],
+        results["total"],
+    )
+    for name in results["groups"]:
+        msg += " | %s_ACC: %.3f%%" % (name.capitalize(), results[name + "_acc"])
+    msg += " | GM: %.3f | Bal ACC: %.3f | F1: %.3f" % (
+        results["test_gm"],
+        results["test_bal_acc"],
+        results["f1_score"],
+    )
+    if logger:
+        logger.log(msg)
+    else:
+        print(msg)
+
+
 def evaluate(
     net,
     dataloader,
@@ -270,86 +578,211 @@ def evaluate(
     is_training = net.training
     net.eval()
     criterion = nn.CrossEntropyLoss()
-    all_targets = []
-    all_predicted = []
-    total_loss = 0.0
-    correct, total = 0.0, 0.0
-    major_correct, neutral_correct, minor_correct = 0.0, 0.0, 0.0
-    major_total, neutral_total, minor_total = 0.0, 0.0, 0.0
-
-    class_correct = torch.zeros(N_CLASSES)
-    class_total = torch.zeros(N_CLASSES)
-
-    for inputs, targets in dataloader:
-        batch_size = inputs.size(0)
-        inputs, targets = inputs.to(device), targets.to(device)
-
-        outputs, _ = net(normalizer(inputs))
-        loss = criterion(outputs, targets)
-        total_loss += loss.item() * batch_size
-        predicted = outputs[:, :N_CLASSES].max(1)[1]
-        total += batch_size
-        correct_mask = predicted == targets
-        correct += sum_t(correct_mask)
-
-        # For accuracy of minority / majority classes.
-        major_mask = targets < (N_CLASSES // 3)
-        major_total += sum_t(major_mask)
-        major_correct += sum_t(correct_mask * major_mask)
-
-        minor_mask = targets >= (N_CLASSES - (N_CLASSES // 3))
-        minor_total += sum_t(minor_mask)
-        minor_correct += sum_t(correct_mask * minor_mask)
-
-        neutral_mask = ~(major_mask + minor_mask)
-        neutral_total += sum_t(neutral_mask)
-        neutral_correct += sum_t(correct_mask * neutral_mask)
-
-        for i in range(N_CLASSES):
-            class_mask = targets == i
-            class_total[i] += sum_t(class_mask)
-            class_correct[i] += sum_t(correct_mask * class_mask)
-        # Calculate recall for each class
-    # calculate recall using class_correct and class_total
-    recall = np.zeros(N_CLASSES)
-    for i in range(N_CLASSES):
-        recall[i] = class_correct[i] / class_total[i]
-    # for debug
-    # print each class's predict, correct, recall
-    bal_acc_score = np.mean(recall)
-    # only use nonzero values
-    recall = recall[recall.nonzero()]
-    gmean_score = gmean(recall)
-    # Calculate balanced accuracy
-    results = {
-        "loss": total_loss / total,
-        "acc": 100.0 * correct / total,
-        "major_acc": 100.0 * major_correct / major_total,
-        "neutral_acc": 100.0 * neutral_correct / neutral_total,
-        "minor_acc": 100.0 * minor_correct / minor_total,
-        "class_acc": 100.0 * class_correct / class_total,
-        "test_bal_acc": 100.0 * bal_acc_score,
-        "test_gm": 100.0 * gmean_score,
-    }
-
-    msg = (
-        "Loss: %.3f | Acc: %.3f%% (%d/%d) | Major_ACC: %.3f%% | Neutral_ACC: %.3f%% | Minor ACC: %.3f%% | GM: %.3f | Bal ACC: %.3f"
-        % (
-            results["loss"],
-            results["acc"],
-            correct,
-            total,
-            results["major_acc"],
-            results["neutral_acc"],
-            results["minor_acc"],
-            results["test_gm"],
-            results["test_bal_acc"],
+    metrics = StreamingMetrics(N_CLASSES, CLASS_GROUPS)
+
+    with torch.no_grad():
+        for inputs, targets in dataloader:
+            inputs, targets = inputs.to(device), targets.to(device)
+
+            with autocast():
+                outputs, _ = net(normalizer(inputs))
+            outputs = outputs.float()
+            loss = criterion(outputs, targets)
+            metrics.update(outputs[:, :N_CLASSES], targets, loss)
+
+    results = get_eval_results(metrics, logger)
+
+    net.train(is_training)
+    return results
+
+
+class EvalSet(object):
+    """
+    The val and test splits pre-materialized once as a normalized tensor.
+    Both splits share `test_cifar`, so one forward pass scores them together.
+    """
+
+    def __init__(self, val_loader, test_loader):
+        dataset = val_loader.dataset
+        assert dataset is test_loader.dataset
+        val_idx = torch.as_tensor(list(val_loader.sampler.indices), dtype=torch.long)
+        test_idx = torch.as_tensor(list(test_loader.sampler.indices), dtype=torch.long)
+        index = torch.cat([val_idx, test_idx])
+
+        # Same as transforms.ToTensor() followed by the normalizer
+        images = torch.from_numpy(np.asarray(dataset.data)[index.numpy()])
+        images = images.permute(0, 3, 1, 2).float().div(255).to(device)
+        with torch.no_grad():
+            self.inputs = normalizer(images)
+        self.targets = torch.as_tensor(np.asarray(dataset.targets)[index.numpy()])
+        self.targets = self.targets.long().to(device)
+        self.n_val = len(val_idx)
+
+
+def evaluate_cached(net, eval_set, logger=None, batch_size=1000):
+    """Score the val and test splits of `eval_set` with one forward pass."""
+    is_training = net.training
+    net.eval()
+
+    with torch.inference_mode(), autocast():
+        outputs = torch.cat(
+            [
+                net(eval_set.inputs[i : i + batch_size])[0].float()
+                for i in range(0, eval_set.inputs.size(0), batch_size)
+            ]
         )
+        losses = F.cross_entropy(outputs, eval_set.targets, reduction="none")
+
+    # Only the val split is logged; the test split is logged by the caller
+    # when it is actually used.
+    n_val = eval_set.n_val
+    outputs, targets = outputs[:, :N_CLASSES], eval_set.targets
+    val_metrics = StreamingMetrics(N_CLASSES, CLASS_GROUPS)
+    val_metrics.update(outputs[:n_val], targets[:n_val], losses[:n_val])
+    test_metrics = StreamingMetrics(N_CLASSES, CLASS_GROUPS)
+    test_metrics.update(outputs[n_val:], targets[n_val:], losses[n_val:])
+    results = (
+        get_eval_results(val_metrics, logger),
+        get_eval_results(test_metrics, False),
     )
-    if logger:
-        logger.log(msg)
-    else:
-        print(msg)
 
     net.train(is_training)
     return results
+
+
+## CSV log ##
+
+LOG_CSV_HEADER = [
+    "epoch",
+    "train loss",
+    "gen loss",
+    "train acc",
+    "gen_acc",
+    "prob_orig",
+    "prob_targ",
+    "train bal acc",
+    "train gm",
+    "test loss",
+    "major test acc",
+    "neutral test acc",
+    "minor test acc",
+    "test acc",
+    "f1 score",
+    "test gm",
+    "test bal acc",
+]
+# Keys of the train and ( best val ) test statistics in every row
+LOG_TRAIN_KEYS = [
+    "train_loss",
+    "gen_loss",
+    "train_acc",
+    "gen_acc",
+    "p_g_orig",
+    "p_g_targ",
+    "train_bal_acc",
+    "train_gm",
+]
+LOG_TEST_KEYS = [
+    "loss",
+    "major_acc",
+    "neutral_acc",
+    "minor_acc",
+    "acc",
+    "f1_score",
+    "test_gm",
+    "test_bal_acc",
+]
+
+
+def init_log_csv(path):
+    if not os.path.exists(path):
+        with open(path, "w") as f:
+            csv_writer = csv.writer(f, delimiter=",")
+            csv_writer.writerow(LOG_CSV_HEADER)
+
+
+def append_log_csv(path, epoch, train_stats, test_stats):
+    def _convert_scala(x):
+        if hasattr(x, "item"):
+            x = x.item()
+        return x
+
+    log_vector = (
+        [epoch]
+        + [train_stats.get(k, 0) for k in LOG_TRAIN_KEYS]
+        + [test_stats.get(k, 0) for k in LOG_TEST_KEYS]
+    )
+    log_vector = list(map(_convert_scala, log_vector))
+
+    with open(path, "a") as f:
+        logwriter = csv.writer(f, delimiter=",")
+        logwriter.writerow(log_vector)
+
+
+## End of a run ##
+
+
+def save_reference_checkpoint(state, epoch):
+    """Keep the checkpoints of the runs that later runs start from ( --net_g )."""
+    if (
+        ARGS.name == "ERM"
+        or ARGS.name == "LDAM"
+        or ARGS.name == "ERM-M2m"
+        or ARGS.name == "LDAM-M2m"
+    ):
+        file_name = f"/home/ubuntu/M2m/checkpoint/{ARGS.name}_{ARGS.model}_{ARGS.dataset}_{ARGS.ratio}.t7"
+        if not os.path.exists(file_name):
+            torch.save(state, file_name)
+        if epoch == ARGS.warm - 1:
+            file_name = f"/home/ubuntu/M2m/checkpoint/{ARGS.name}_{ARGS.model}_{ARGS.dataset}_{ARGS.ratio}_warm.t7"
+            torch.save(state, file_name)
+
+
+def report_run(log_csv, table_key="table"):
+    """
+    Log the CSV of a finished run to wandb and record its best test row in the
+    csv/ summary of its dataset.
+    """
+    df = pd.read_csv(log_csv)
+    df_table = wandb.Table(dataframe=df)
+    csv_folder = os.path.join("/home/ubuntu/M2m/", "csv")
+    os.makedirs(csv_folder, exist_ok=True)
+    test_last_idx = df["test bal acc"].idxmax()
+    test_last_result = df.loc[test_last_idx]
+    test_last_result["name"] = ARGS.name
+    test_last_result["model"] = ARGS.model
+    file_name = f"{ARGS.dataset}_{ARGS.ratio}_{ARGS.n_samples}.csv"
+    # specify the path to the csv file
+    csv_file_path = os.path.join(csv_folder, file_name)
+    new_df = pd.DataFrame([test_last_result]).round(2)
+    # check if the file exists
+    if os.path.isfile(csv_file_path):
+        # load the existing csv file into a DataFrame
+        existing_df = pd.read_csv(csv_file_path)
+
+        # check if ARGS.name is already in the DataFrame
+        if ARGS.name not in existing_df["name"].values:
+            # if not, append test_last_result to the DataFrame
+            existing_df = pd.concat([existing_df, new_df], axis=0, ignore_index=True)
+
+            # save the DataFrame to the csv file
+            existing_df.round(2).to_csv(csv_file_path, index=False)
+        elif ARGS.name in existing_df["name"].values:
+            # if ARGS.name is already in the DataFrame, update the row with test_last_result if the test accuracy of the new result is higher
+            existing_idx = existing_df[existing_df["name"] == ARGS.name].index[0]
+            if (
+                test_last_result["test bal acc"]
+                > existing_df.loc[existing_idx]["test bal acc"]
+            ) and (
+                test_last_result["test gm"] > existing_df.loc[existing_idx]["test gm"]
+            ):
+                existing_df.loc[existing_idx] = test_last_result.round(2)
+
+                # save the DataFrame to the csv file
+                existing_df.round(2).to_csv(csv_file_path, index=False)
+    else:
+        # if the file doesn't exist, create a new DataFrame from test_last_result
+
+        # save the new DataFrame to the csv file
+        new_df.to_csv(csv_file_path, index=False)
+    wandb.log({table_key: df_table})
@@ -1,19 +1,35 @@
 import bisect
 import os
+import shutil
 
 import numpy as np
 import numpy.random as nr
 import torch
+import torch.nn.functional as F
 from PIL import Image
 from scipy import io
 from torch.utils.data import DataLoader, Dataset, TensorDataset
-from torch.utils.data.sampler import SubsetRandomSampler, WeightedRandomSampler
+from torch.utils.data.sampler import (
+    Sampler,
+    SubsetRandomSampler,
+    WeightedRandomSampler,
+)
 from torchvision import datasets, transforms
 
 num_test_samples_cifar10 = [1000] * 10
 num_test_samples_cifar100 = [100] * 100
 
 DATA_ROOT = os.path.expanduser("~/data")
+CACHE_ROOT = os.path.join(DATA_ROOT, "cifar_lt_cache")
+CACHE_FILES = [
+    "counts",
+    "train_data",
+    "train_targets",
+    "test_data",
+    "test_targets",
+    "val_idx",
+    "test_idx",
+]
 
 
 def make_longtailed_imb(max_num, class_num, gamma):
@@ -26,6 +42,48 @@ def make_longtailed_imb(max_num, class_num, gamma):
     return list(class_num_list)
 
 
+def get_targets(dataset):
+    """
+    Return the labels of a dataset as an integer array.
+    Reads `dataset.targets` when available so that no image is decoded.
+    """
+    if hasattr(dataset, "targets"):
+        return np.asarray(dataset.targets, dtype=np.int64)
+    return np.array([dataset[i][1] for i in range(len(dataset))], dtype=np.int64)
+
+
+def get_class_rank(targets):
+    """
+    Return, for every position, how many samples of the same class precede it.
+    Input: An array of labels (in the order they are visited)
+    Output: An array of the same length with per-class occurrence ranks
+    """
+    targets = np.asarray(targets, dtype=np.int64)
+    if len(targets) == 0:
+        return np.zeros(0, dtype=np.int64)
+    order = np.argsort(targets, kind="stable")
+    counts = np.bincount(targets)
+    starts = np.cumsum(counts) - counts
+    rank = np.empty(len(targets), dtype=np.int64)
+    rank[order] = np.arange(len(targets)) - np.repeat(starts, counts)
+
+    return rank
+
+
+def get_class_indices(targets, n_class=None):
+    """
+    Return a list of index arrays, one per class, in ascending index order.
+    Equivalent to [np.where(targets == i)[0] for i in range(n_class)].
+    """
+    targets = np.asarray(targets, dtype=np.int64)
+    if n_class is None:
+        n_class = int(targets.max()) + 1
+    order = np.argsort(targets, kind="stable")
+    counts = np.bincount(targets, minlength=n_class)[:n_class]
+
+    return np.split(order[: counts.sum()], np.cumsum(counts)[:-1])
+
+
 def get_val_test_data(dataset, num_sample_per_class, shuffle=False, random_seed=0):
     """
     Return a list of indices for validation and test from a dataset.
@@ -33,25 +91,21 @@ def get_val_test_data(dataset, num_sample_per_class, shuffle=False, random_seed=
     Output: validation_list and test_list
     """
     length = dataset.__len__()
-    num_sample_per_class = list(num_sample_per_class)
+    num_sample_per_class = np.asarray(num_sample_per_class)
     num_samples = num_sample_per_class[
         0
     ]  # Suppose that all classes have the same number of test samples
 
-    val_list = []
-    test_list = []
-    indices = list(range(0, length))
+    indices = np.arange(length)
     if shuffle:
         nr.shuffle(indices)
-    for i in range(0, length):
-        index = indices[i]
-        _, label = dataset.__getitem__(index)
-        if num_sample_per_class[label] > (9 * num_samples / 10):
-            val_list.append(index)
-            num_sample_per_class[label] -= 1
-        else:
-            test_list.append(index)
-            num_sample_per_class[label] -= 1
+    labels = get_targets(dataset)[indices]
+    # The first 10% of every class (in visiting order) goes to validation
+    remaining = num_sample_per_class[labels] - get_class_rank(labels)
+    is_val = remaining > (9 * num_samples / 10)
+
+    val_list = indices[is_val].tolist()
+    test_list = indices[~is_val].tolist()
 
     return val_list, test_list
 
@@ -62,18 +116,11 @@ def get_oversampled_data(dataset, num_sample_per_class, random_seed=0):
     Input: A dataset (e.g., CIFAR-10), num_sample_per_class: list of integers
     Output: oversampled_list ( weights are increased )
     """
-    length = dataset.__len__()
-    num_sample_per_class = list(num_sample_per_class)
-    num_samples = list(num_sample_per_class)
-
-    selected_list = []
-    indices = list(range(0, length))
-    for i in range(0, length):
-        index = indices[i]
-        _, label = dataset.__getitem__(index)
-        if num_sample_per_class[label] > 0:
-            selected_list.append(1 / num_samples[label])
-            num_sample_per_class[label] -= 1
+    num_samples = np.asarray(num_sample_per_class)
+
+    labels = get_targets(dataset)
+    selected = get_class_rank(labels) < num_samples[labels]
+    selected_list = (1 / num_samples[labels[selected]]).tolist()
 
     return selected_list
 
@@ -84,44 +131,25 @@ def get_imbalanced_data(dataset, num_sample_per_class, shuffle=False, random_see
     Input: A dataset (e.g., CIFAR-10), num_sample_per_class: list of integers
     Output: imbalanced_list
     """
-    length = dataset.__len__()
-    num_sample_per_class = list(num_sample_per_class)
-    selected_list = []
-    indices = list(range(0, length))
+    num_sample_per_class = np.asarray(num_sample_per_class)
 
-    for i in range(0, length):
-        index = indices[i]
-        _, label = dataset.__getitem__(index)
-        if num_sample_per_class[label] > 0:
-            selected_list.append(index)
-            num_sample_per_class[label] -= 1
+    labels = get_targets(dataset)
+    selected = get_class_rank(labels) < num_sample_per_class[labels]
+    selected_list = np.flatnonzero(selected).tolist()
 
     return selected_list
 
 
-def get_oversampled(dataset, num_sample_per_class, batch_size, TF_train, TF_test):
-    print("Building {} CV data loader with {} workers".format(dataset, 8))
-    ds = []
-
-    if dataset == "cifar10":
-        dataset_ = datasets.CIFAR10
-        num_test_samples = num_test_samples_cifar10
-    elif dataset == "cifar100":
-        dataset_ = datasets.CIFAR100
-        num_test_samples = num_test_samples_cifar100
-    else:
-        raise NotImplementedError()
-
-    train_cifar = dataset_(
-        root=DATA_ROOT, train=True, download=True, transform=TF_train
-    )
-
-    targets = np.array(train_cifar.targets)
-    classes, class_counts = np.unique(targets, return_counts=True)
-    nb_classes = len(classes)
+def get_imbalanced_cifar(train_cifar, num_sample_per_class):
+    """
+    Keep the first `num_sample_per_class[i]` samples of every class i
+    in `train_cifar` (in place), grouped by class.
+    """
+    targets = get_targets(train_cifar)
+    nb_classes = len(np.unique(targets))
 
     imbal_class_counts = [int(i) for i in num_sample_per_class]
-    class_indices = [np.where(targets == i)[0] for i in range(nb_classes)]
+    class_indices = get_class_indices(targets, nb_classes)
 
     imbal_class_indices = [
         class_idx[:class_count]
@@ -134,34 +162,167 @@ def get_oversampled(dataset, num_sample_per_class, batch_size, TF_train, TF_test
 
     assert len(train_cifar.targets) == len(train_cifar.data)
 
-    train_in_idx = get_oversampled_data(train_cifar, num_sample_per_class)
-    train_in_loader = DataLoader(
-        train_cifar,
-        batch_size=batch_size,
-        sampler=WeightedRandomSampler(train_in_idx, len(train_in_idx)),
-        num_workers=8,
-    )
-    ds.append(train_in_loader)
+    return nb_classes
 
-    test_cifar = dataset_(root=DATA_ROOT, train=False, download=True, transform=TF_test)
-    val_idx, test_idx = get_val_test_data(test_cifar, num_test_samples)
-    val_loader = DataLoader(
-        test_cifar, batch_size=100, sampler=SubsetRandomSampler(val_idx), num_workers=8
-    )
-    test_loader = DataLoader(
-        test_cifar, batch_size=100, sampler=SubsetRandomSampler(test_idx), num_workers=8
-    )
-    ds.append(val_loader)
-    ds.append(test_loader)
-    ds = ds[0] if len(ds) == 1 else ds
 
-    return ds
+def get_oversampled_class_weights(targets, num_sample_per_class):
+    """
+    Return the per-class weights equivalent to the per-sample weights of
+    `get_oversampled_data` ( count / num_sample_per_class for every class ).
+    """
+    n_class = len(num_sample_per_class)
+    counts = np.bincount(np.asarray(targets, dtype=np.int64), minlength=n_class)
+    return counts[:n_class] / np.asarray(num_sample_per_class)
 
 
-def get_imbalanced(dataset, num_sample_per_class, batch_size, TF_train, TF_test):
-    print("Building CV {} data loader with {} workers".format(dataset, 8))
-    ds = []
+class ClassAwareSampler(Sampler):
+    """
+    Pick a class according to `class_weights`, then an index uniformly within
+    that class. This is the distribution WeightedRandomSampler gives for
+    per-sample weights w_c / n_c, without a per-sample weight vector: an epoch
+    is one multinomial over the classes plus one uniform draw per sample.
+    Classes default to uniform weights. Draws come from `generator` if given.
+    """
+
+    def __init__(
+        self,
+        targets,
+        class_weights=None,
+        num_samples=None,
+        n_class=None,
+        generator=None,
+    ):
+        targets = np.asarray(targets, dtype=np.int64)
+        class_indices = get_class_indices(targets, n_class)
+        counts = np.array([len(idx) for idx in class_indices])
+
+        if class_weights is None:
+            class_weights = (counts > 0).astype(np.float64)
+        class_weights = np.asarray(class_weights, dtype=np.float64)
+        # Empty classes can not be drawn
+        class_weights = np.where(counts > 0, class_weights, 0.0)
+
+        self.order = torch.from_numpy(np.concatenate(class_indices).astype(np.int64))
+        self.starts = torch.from_numpy(np.cumsum(counts) - counts)
+        self.counts = torch.from_numpy(counts)
+        self.class_weights = torch.from_numpy(class_weights)
+        self.num_samples = len(targets) if num_samples is None else num_samples
+        self.generator = generator
+
+    def __len__(self):
+        return self.num_samples
+
+    def sample(self):
+        cls = torch.multinomial(
+            self.class_weights,
+            self.num_samples,
+            replacement=True,
+            generator=self.generator,
+        )
+        offset = torch.rand(
+            self.num_samples, dtype=torch.double, generator=self.generator
+        )
+        offset = offset * self.counts[cls]
+        offset = offset.long()
+        return self.order[self.starts[cls] + offset]
+
+    def __iter__(self):
+        return iter(self.sample().tolist())
+
+
+class CIFARArray(Dataset):
+    """
+    CIFAR-style dataset over (possibly memory-mapped) uint8 arrays.
+    Behaves like torchvision's CIFAR10/100 once they are loaded.
+    """
+
+    def __init__(self, data, targets, transform=None):
+        self.data = data
+        self.targets = targets
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        img, target = self.data[index], int(self.targets[index])
+        img = Image.fromarray(np.asarray(img))
+
+        if self.transform is not None:
+            img = self.transform(img)
+
+        return img, target
+
+
+class IndexedDataset(Dataset):
+    """Wrap a dataset so that every sample also returns its index."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
 
+    def __getitem__(self, index):
+        img, target = self.dataset[index]
+        return img, target, index
+
+
+def get_cache_key(dataset, ratio, n_samples, imb_type, imb_start):
+    return "{}_R{}_N{}_{}_S{}".format(dataset, ratio, n_samples, imb_type, imb_start)
+
+
+def _load_split(cache_dir):
+    try:
+        return {
+            name: np.load(os.path.join(cache_dir, name + ".npy"), mmap_mode="r")
+            for name in CACHE_FILES
+        }
+    except (IOError, ValueError):
+        return None
+
+
+def _save_split(cache_dir, split, replace=False):
+    # Write into a private directory first so that concurrent runs never
+    # observe a partially written cache; the first rename wins. With
+    # `replace`, an existing cache is moved aside first ( runs that opened
+    # it keep their memory-mapped files ).
+    os.makedirs(CACHE_ROOT, exist_ok=True)
+    tmp_dir = "{}.tmp{}".format(cache_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    for name in CACHE_FILES:
+        np.save(os.path.join(tmp_dir, name + ".npy"), np.asarray(split[name]))
+    old_dir = "{}.old{}".format(cache_dir, os.getpid())
+    if replace:
+        try:
+            os.rename(cache_dir, old_dir)
+        except OSError:
+            pass
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+# Splits already loaded by this process, shared by the runs of a sweep
+_SPLITS = {}
+
+
+def load_cifar_lt(dataset, num_sample_per_class, cache_key=None):
+    """
+    Return the long-tailed train split and the val/test split of CIFAR as arrays.
+    With `cache_key`, the split is stored under CACHE_ROOT as .npy files and
+    later runs open them read-only with memory-mapping. Either way a split is
+    only built once per process ( see sweep.py ).
+    """
+    key = (dataset, tuple(np.asarray(num_sample_per_class).tolist()), cache_key)
+    if key not in _SPLITS:
+        _SPLITS[key] = _load_cifar_lt(dataset, num_sample_per_class, cache_key)
+    return _SPLITS[key]
+
+
+def _load_cifar_lt(dataset, num_sample_per_class, cache_key=None):
     if dataset == "cifar10":
         dataset_ = datasets.CIFAR10
         num_test_samples = num_test_samples_cifar10
@@ -171,26 +332,337 @@ def get_imbalanced(dataset, num_sample_per_class, batch_size, TF_train, TF_test)
     else:
         raise NotImplementedError()
 
-    train_cifar = dataset_(
-        root=DATA_ROOT, train=True, download=True, transform=TF_train
-    )
-    train_in_idx = get_imbalanced_data(train_cifar, num_sample_per_class)
-    train_in_loader = torch.utils.data.DataLoader(
-        train_cifar,
-        batch_size=batch_size,
-        sampler=SubsetRandomSampler(train_in_idx),
-        num_workers=8,
-    )
-    ds.append(train_in_loader)
-
-    test_cifar = dataset_(root=DATA_ROOT, train=False, download=True, transform=TF_test)
+    required = np.ceil(np.asarray(num_sample_per_class, dtype=np.float64))
+    cache_dir = None
+    replace = False
+    if cache_key is not None:
+        cache_dir = os.path.join(CACHE_ROOT, cache_key)
+        split = _load_split(cache_dir) if os.path.isdir(cache_dir) else None
+        if split is not None:
+            if np.all(required <= split["counts"]):
+                print("Loading cached {} split from {}".format(dataset, cache_dir))
+                return split
+            # Requested more samples than cached (e.g. different counts):
+            # rebuild the split with enough samples for both and replace the
+            # cache. Samples are the first ones of each class, so the runs of
+            # the old split read the same samples from the new one.
+            print("Cached split {} is too small, rebuilding".format(cache_dir))
+            required = np.maximum(required, split["counts"])
+            replace = True
+
+    train_cifar = dataset_(root=DATA_ROOT, train=True, download=True)
+    train_idx = get_imbalanced_data(train_cifar, required.astype(np.int64))
+    train_targets = get_targets(train_cifar)[train_idx]
+
+    test_cifar = dataset_(root=DATA_ROOT, train=False, download=True)
     val_idx, test_idx = get_val_test_data(test_cifar, num_test_samples)
-    val_loader = torch.utils.data.DataLoader(
+
+    split = {
+        "counts": np.bincount(train_targets, minlength=len(num_test_samples)),
+        "train_data": train_cifar.data[train_idx],
+        "train_targets": train_targets,
+        "test_data": test_cifar.data,
+        "test_targets": get_targets(test_cifar),
+        "val_idx": np.asarray(val_idx, dtype=np.int64),
+        "test_idx": np.asarray(test_idx, dtype=np.int64),
+    }
+    if cache_dir is not None:
+        _save_split(cache_dir, split, replace)
+
+    return split
+
+
+def get_val_test_loaders(split, TF_test):
+    test_cifar = CIFARArray(split["test_data"], split["test_targets"], TF_test)
+    val_idx, test_idx = split["val_idx"].tolist(), split["test_idx"].tolist()
+    val_loader = DataLoader(
         test_cifar, batch_size=100, sampler=SubsetRandomSampler(val_idx), num_workers=8
     )
-    test_loader = torch.utils.data.DataLoader(
+    test_loader = DataLoader(
         test_cifar, batch_size=100, sampler=SubsetRandomSampler(test_idx), num_workers=8
     )
+
+    return val_loader, test_loader
+
+
+class DeviceLoader(object):
+    """
+    Training loader over a CIFAR set kept as one uint8 tensor on `device`.
+    Random crop ( padding 4 ) and horizontal flip are applied to whole
+    batches with tensor indexing instead of per-image PIL transforms.
+    Without `weights` every epoch is a random permutation (as with
+    SubsetRandomSampler or shuffle=True); with `weights` indices are drawn
+    with replacement (as with WeightedRandomSampler).
+    A `sampler` with a `sample()` method (e.g. ClassAwareSampler) overrides
+    both.
+    `pairs` is an optional SMOTE (seed, neighbour, label) table whose samples
+    are interpolated on the device with a fresh lambda at every draw.
+    With `return_index`, batches also carry the dataset indices.
+    With `seed`, sampling and augmentation use a generator of their own.
+    """
+
+    def __init__(
+        self,
+        data,
+        targets,
+        batch_size,
+        device,
+        weights=None,
+        num_samples=None,
+        augment=True,
+        padding=4,
+        pairs=None,
+        sampler=None,
+        return_index=False,
+        seed=None,
+    ):
+        self.device = device
+        self.batch_size = batch_size
+        self.augment = augment
+        self.padding = padding
+
+        data = torch.from_numpy(np.ascontiguousarray(data))
+        self.data = data.permute(0, 3, 1, 2).contiguous().to(device)
+        self.targets = torch.as_tensor(np.asarray(targets), dtype=torch.long)
+        self.targets = self.targets.to(device)
+        self.n_real = len(self.data)
+
+        self.pairs = None
+        if pairs is not None:
+            self.pairs = [torch.as_tensor(p, dtype=torch.long) for p in pairs]
+            self.pairs = [p.to(device) for p in self.pairs]
+        n_total = self.n_real + (0 if pairs is None else len(pairs[2]))
+
+        self.weights = None
+        if weights is not None:
+            self.weights = torch.as_tensor(weights, dtype=torch.double).to(device)
+        self.num_samples = n_total if num_samples is None else num_samples
+        self.return_index = return_index
+        self.sampler = sampler
+        if sampler is not None:
+            self.num_samples = len(sampler)
+
+        size = self.data.shape[-1]
+        self._arange = torch.arange(size, device=device)
+
+        self.generator = None
+        if seed is not None:
+            self.generator = torch.Generator(device=device)
+            self.generator.manual_seed(seed)
+
+    def __len__(self):
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def _indices(self):
+        if self.sampler is not None:
+            return self.sampler.sample().to(self.device)
+        if self.weights is None:
+            return torch.randperm(
+                self.num_samples, device=self.device, generator=self.generator
+            )
+        return torch.multinomial(
+            self.weights, self.num_samples, replacement=True, generator=self.generator
+        )
+
+    def _gather(self, idx):
+        if self.pairs is None:
+            return self.data[idx], self.targets[idx]
+
+        seeds, partners, labels = self.pairs
+        is_aug = idx >= self.n_real
+        real_idx = idx.clamp(max=self.n_real - 1)
+        aug_idx = (idx - self.n_real).clamp(min=0)
+
+        lam = torch.rand(
+            len(idx), 1, 1, 1, device=self.device, generator=self.generator
+        )
+        synth = self.data[seeds[aug_idx]] * lam
+        synth = synth + self.data[partners[aug_idx]] * (1 - lam)
+        synth = synth.round().to(torch.uint8)
+
+        images = torch.where(is_aug.view(-1, 1, 1, 1), synth, self.data[real_idx])
+        targets = torch.where(is_aug, labels[aug_idx], self.targets[real_idx])
+        return images, targets
+
+    def _augment(self, images):
+        # Crop a (size x size) window from the zero-padded batch and flip it
+        # by reversing the column indices, all in a single gather.
+        n, size = images.size(0), images.size(-1)
+        pad = self.padding
+        padded = F.pad(images, (pad, pad, pad, pad))
+
+        gen = self.generator
+        offset_y = torch.randint(
+            0, 2 * pad + 1, (n, 1), device=self.device, generator=gen
+        )
+        offset_x = torch.randint(
+            0, 2 * pad + 1, (n, 1), device=self.device, generator=gen
+        )
+        flip = torch.rand(n, 1, device=self.device, generator=gen) < 0.5
+
+        rows = offset_y + self._arange
+        cols = offset_x + torch.where(flip, size - 1 - self._arange, self._arange)
+
+        batch_idx = torch.arange(n, device=self.device).view(-1, 1, 1, 1)
+        channel_idx = torch.arange(images.size(1), device=self.device)
+        return padded[
+            batch_idx,
+            channel_idx.view(1, -1, 1, 1),
+            rows.view(n, 1, -1, 1),
+            cols.view(n, 1, 1, -1),
+        ]
+
+    def __iter__(self):
+        indices = self._indices()
+        for start in range(0, self.num_samples, self.batch_size):
+            idx = indices[start : start + self.batch_size]
+            images, targets = self._gather(idx)
+            if self.augment:
+                images = self._augment(images)
+            if self.return_index:
+                yield images.float().div_(255), targets, idx
+            else:
+                yield images.float().div_(255), targets
+
+
+def get_train_images(data_loader):
+    """
+    Return the un-augmented uint8 (N, C, H, W) images and the targets of
+    the training samples behind a DeviceLoader, or a DataLoader of
+    get_imbalanced ( SubsetRandomSampler ) or get_oversampled
+    ( WeightedRandomSampler or ClassAwareSampler ).
+    """
+    if isinstance(data_loader, DeviceLoader):
+        n_real = data_loader.n_real
+        return data_loader.data[:n_real], data_loader.targets[:n_real]
+
+    dataset = data_loader.dataset
+    if isinstance(dataset, IndexedDataset):
+        dataset = dataset.dataset
+    sampler = data_loader.sampler
+    if isinstance(sampler, SubsetRandomSampler):
+        index = np.asarray(list(sampler.indices))
+    elif isinstance(sampler, WeightedRandomSampler):
+        index = np.flatnonzero(sampler.weights.numpy() > 0)
+    elif isinstance(sampler, ClassAwareSampler):
+        index = np.sort(sampler.order.numpy())
+    else:
+        raise ValueError(
+            "get_train_images supports DeviceLoader and DataLoader with a "
+            "SubsetRandomSampler, WeightedRandomSampler or ClassAwareSampler, "
+            "not a %s" % type(sampler).__name__
+        )
+    images = torch.from_numpy(np.asarray(dataset.data)[index]).permute(0, 3, 1, 2)
+    targets = torch.as_tensor(np.asarray(dataset.targets)[index], dtype=torch.long)
+    return images.contiguous(), targets
+
+
+def get_class_draws(data_loader, n_class):
+    """
+    Expected number of samples of each class that one epoch of a training
+    loader draws: a DeviceLoader, or a DataLoader whose sampler is uniform
+    over its indices ( SubsetRandomSampler, RandomSampler ), a
+    WeightedRandomSampler or a ClassAwareSampler.
+    """
+    weights = None
+    if isinstance(data_loader, DeviceLoader):
+        sampler = data_loader.sampler
+        targets = data_loader.targets[: data_loader.n_real].cpu()
+        if data_loader.pairs is not None:
+            targets = torch.cat([targets, data_loader.pairs[2].cpu()])
+        if data_loader.weights is not None:
+            weights = data_loader.weights.cpu()
+        num_samples = data_loader.num_samples
+    else:
+        sampler = data_loader.sampler
+        dataset = data_loader.dataset
+        if isinstance(dataset, IndexedDataset):
+            dataset = dataset.dataset
+        targets = torch.as_tensor(np.asarray(dataset.targets), dtype=torch.long)
+        if isinstance(sampler, SubsetRandomSampler):
+            targets = targets[torch.as_tensor(list(sampler.indices))]
+        elif isinstance(sampler, WeightedRandomSampler):
+            weights = sampler.weights
+        num_samples = len(sampler)
+
+    if isinstance(sampler, ClassAwareSampler):
+        share = sampler.class_weights.double()
+        share = F.pad(share, (0, n_class - share.size(0)))
+    elif weights is not None:
+        share = torch.bincount(targets, weights=weights.double(), minlength=n_class)
+    else:
+        share = torch.bincount(targets, minlength=n_class).double()
+    return num_samples * share / share.sum()
+
+
+def _seeded_generator(seed):
+    """CPU generator seeded with `seed`, or None for the global RNG."""
+    if seed is None:
+        return None
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    return generator
+
+
+def get_oversampled(
+    dataset,
+    num_sample_per_class,
+    batch_size,
+    TF_train,
+    TF_test,
+    cache_key=None,
+    device=None,
+    augment=True,
+    class_aware=False,
+    return_index=False,
+    seed=None,
+):
+    print("Building {} CV data loader with {} workers".format(dataset, 8))
+    ds = []
+    generator = _seeded_generator(seed)
+
+    split = load_cifar_lt(dataset, num_sample_per_class, cache_key)
+    train_cifar = CIFARArray(split["train_data"], split["train_targets"], TF_train)
+
+    nb_classes = get_imbalanced_cifar(train_cifar, num_sample_per_class)
+
+    if class_aware:
+        class_weights = get_oversampled_class_weights(
+            train_cifar.targets, num_sample_per_class
+        )
+        sampler = ClassAwareSampler(
+            train_cifar.targets, class_weights, n_class=nb_classes, generator=generator
+        )
+        train_in_idx = None
+    else:
+        train_in_idx = get_oversampled_data(train_cifar, num_sample_per_class)
+        sampler = WeightedRandomSampler(
+            train_in_idx, len(train_in_idx), generator=generator
+        )
+
+    if device is not None:
+        train_in_loader = DeviceLoader(
+            train_cifar.data,
+            train_cifar.targets,
+            batch_size,
+            device,
+            weights=train_in_idx,
+            augment=augment,
+            sampler=sampler if class_aware else None,
+            return_index=return_index,
+            seed=seed,
+        )
+    else:
+        train_in_loader = DataLoader(
+            IndexedDataset(train_cifar) if return_index else train_cifar,
+            batch_size=batch_size,
+            sampler=sampler,
+            num_workers=8,
+            generator=generator,
+        )
+    ds.append(train_in_loader)
+
+    val_loader, test_loader = get_val_test_loaders(split, TF_test)
     ds.append(val_loader)
     ds.append(test_loader)
     ds = ds[0] if len(ds) == 1 else ds
@@ -198,97 +670,299 @@ def get_imbalanced(dataset, num_sample_per_class, batch_size, TF_train, TF_test)
     return ds
 
 
-def smote(data, targets, n_class, n_max):
-    aug_data = []
-    aug_label = []
+def get_imbalanced(
+    dataset,
+    num_sample_per_class,
+    batch_size,
+    TF_train,
+    TF_test,
+    cache_key=None,
+    device=None,
+    augment=True,
+    return_index=False,
+    seed=None,
+):
+    print("Building CV {} data loader with {} workers".format(dataset, 8))
+    ds = []
+    generator = _seeded_generator(seed)
 
-    for k in range(1, n_class):
-        indices = np.where(targets == k)[0]
-        class_data = data[indices]
-        class_len = len(indices)
-        class_dist = np.zeros((class_len, class_len))
+    split = load_cifar_lt(dataset, num_sample_per_class, cache_key)
+    train_cifar = CIFARArray(split["train_data"], split["train_targets"], TF_train)
+    train_in_idx = get_imbalanced_data(train_cifar, num_sample_per_class)
+    if device is not None:
+        train_in_loader = DeviceLoader(
+            train_cifar.data[train_in_idx],
+            train_cifar.targets[train_in_idx],
+            batch_size,
+            device,
+            augment=augment,
+            return_index=return_index,
+            seed=seed,
+        )
+    else:
+        train_in_loader = torch.utils.data.DataLoader(
+            IndexedDataset(train_cifar) if return_index else train_cifar,
+            batch_size=batch_size,
+            sampler=SubsetRandomSampler(train_in_idx, generator=generator),
+            num_workers=8,
+            generator=generator,
+        )
+    ds.append(train_in_loader)
 
-        # Augmentation with SMOTE ( k-nearest )
-        if smote:
-            for i in range(class_len):
-                for j in range(class_len):
-                    class_dist[i, j] = np.linalg.norm(class_data[i] - class_data[j])
-            sorted_idx = np.argsort(class_dist)
+    val_loader, test_loader = get_val_test_loaders(split, TF_test)
+    ds.append(val_loader)
+    ds.append(test_loader)
+    ds = ds[0] if len(ds) == 1 else ds
 
-            for i in range(n_max - class_len):
-                lam = nr.uniform(0, 1)
-                row_idx = i % class_len
-                col_idx = int((i - row_idx) / class_len) % (class_len - 1)
-                new_data = np.round(
-                    lam * class_data[row_idx]
-                    + (1 - lam) * class_data[sorted_idx[row_idx, 1 + col_idx]]
-                )
+    return ds
 
-                aug_data.append(new_data.astype("uint8"))
-                aug_label.append(k)
 
-    return np.array(aug_data), np.array(aug_label)
+def _wrapped_distances(rows, cols):
+    """
+    Squared distances of uint8 images whose differences wrap around modulo
+    256, as np.linalg.norm(a - b) computed them in the original smote().
+    """
+    dist = np.empty((len(rows), len(cols)))
+    for i, row in enumerate(rows):
+        diff = (row - cols).astype(np.float64)
+        dist[i] = np.einsum("ij,ij->i", diff, diff)
+    return dist
 
 
-def get_smote(dataset, num_sample_per_class, batch_size, TF_train, TF_test):
-    print("Building CV {} data loader with {} workers".format(dataset, 8))
-    ds = []
+def knn_indices(data, n_neighbors, block_size=1024, legacy_distance=False):
+    """
+    Return the indices of the `n_neighbors` nearest samples (L2) of every
+    sample in `data`, excluding itself, sorted from the nearest.
+    Distances are computed tile by tile through matrix products and only the
+    running top-k is kept, so memory is O(block_size * (block_size + k)).
+    With `legacy_distance`, uint8 differences wrap around as in the original
+    smote(), which reproduces its neighbours ( up to ties ), much slower.
+    """
+    x = np.asarray(data).reshape(len(data), -1)
+    n = len(x)
+    n_neighbors = min(n_neighbors, n - 1)
+    if n_neighbors <= 0:
+        return np.zeros((n, 0), dtype=np.int64)
+
+    # Squared distances of uint8 images are integers below 2**53, hence exact
+    sq_norm = np.einsum("ij,ij->i", x.astype(np.float64), x.astype(np.float64))
+    neighbors = np.empty((n, n_neighbors), dtype=np.int64)
+
+    for r in range(0, n, block_size):
+        rows = x[r : r + block_size].astype(np.float64)
+        row_idx = np.arange(r, r + len(rows))
+        best_dist = np.zeros((len(rows), 0))
+        best_idx = np.zeros((len(rows), 0), dtype=np.int64)
+
+        for c in range(0, n, block_size):
+            cols = x[c : c + block_size].astype(np.float64)
+            col_idx = np.arange(c, c + len(cols))
+            if legacy_distance:
+                dist = _wrapped_distances(x[r : r + block_size], x[c : c + block_size])
+            else:
+                dist = sq_norm[row_idx, None] + sq_norm[None, col_idx]
+                dist -= 2 * rows @ cols.T
+            dist[row_idx[:, None] == col_idx[None, :]] = np.inf
+
+            best_dist = np.concatenate((best_dist, dist), axis=1)
+            best_idx = np.concatenate(
+                (best_idx, np.broadcast_to(col_idx, dist.shape)), axis=1
+            )
+            if best_dist.shape[1] > n_neighbors:
+                part = np.argpartition(best_dist, n_neighbors - 1, axis=1)
+                part = part[:, :n_neighbors]
+                best_dist = np.take_along_axis(best_dist, part, axis=1)
+                best_idx = np.take_along_axis(best_idx, part, axis=1)
+
+        # Nearest first, ties broken by index
+        order = np.lexsort((best_idx, best_dist))
+        neighbors[row_idx] = np.take_along_axis(best_idx, order, axis=1)
+
+    return neighbors
+
+
+def smote_pairs(
+    data,
+    targets,
+    n_class,
+    n_max,
+    n_neighbors=None,
+    block_size=1024,
+    legacy_distance=False,
+):
+    """
+    Return the (seed, neighbour, label) triplets of the SMOTE samples that
+    over-sample every class except class 0 up to `n_max` samples.
+    `n_neighbors` limits the candidate neighbours of each sample; by default
+    exactly as many as the number of generated samples can reach are used.
+    `legacy_distance` is passed to knn_indices.
+    """
+    seeds, partners, labels = [], [], []
 
-    if dataset == "cifar10":
-        dataset_ = datasets.CIFAR10
-        num_test_samples = num_test_samples_cifar10
-    elif dataset == "cifar100":
-        dataset_ = datasets.CIFAR100
-        num_test_samples = num_test_samples_cifar100
-    else:
-        raise NotImplementedError()
+    for k in range(1, n_class):
+        indices = np.where(targets == k)[0]
+        class_len = len(indices)
+        n_gen = n_max - class_len
+        if n_gen <= 0:
+            continue
 
-    train_cifar = dataset_(
-        root=DATA_ROOT, train=True, download=True, transform=TF_train
+        # Augmentation with SMOTE ( k-nearest )
+        n_reach = min(class_len - 1, (n_gen - 1) // class_len + 1)
+        if n_neighbors is not None:
+            n_reach = min(n_reach, n_neighbors)
+        if n_reach > 0:
+            sorted_idx = knn_indices(
+                data[indices], n_reach, block_size, legacy_distance
+            )
+        else:
+            # A single sample has no neighbour but itself
+            sorted_idx, n_reach = np.arange(class_len).reshape(-1, 1), 1
+
+        i = np.arange(n_gen)
+        row_idx = i % class_len
+        col_idx = (i // class_len) % n_reach
+        seeds.append(indices[row_idx])
+        partners.append(indices[sorted_idx[row_idx, col_idx]])
+        labels.append(np.full(n_gen, k, dtype=np.int64))
+
+    if not seeds:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64)
+
+    return np.concatenate(seeds), np.concatenate(partners), np.concatenate(labels)
+
+
+def smote(
+    data,
+    targets,
+    n_class,
+    n_max,
+    n_neighbors=None,
+    block_size=1024,
+    legacy_distance=False,
+):
+    aug_data = []
+    seeds, partners, aug_label = smote_pairs(
+        data, targets, n_class, n_max, n_neighbors, block_size, legacy_distance
     )
 
-    targets = np.array(train_cifar.targets)
-    classes, class_counts = np.unique(targets, return_counts=True)
-    nb_classes = len(classes)
+    for start in range(0, len(aug_label), block_size):
+        seed_idx = seeds[start : start + block_size]
+        lam = nr.uniform(0, 1, size=len(seed_idx))
+        lam = lam.reshape((-1,) + (1,) * (data.ndim - 1))
+        new_data = np.round(
+            lam * data[seed_idx]
+            + (1 - lam) * data[partners[start : start + block_size]]
+        )
+        aug_data.append(new_data.astype("uint8"))
 
-    imbal_class_counts = [int(i) for i in num_sample_per_class]
-    class_indices = [np.where(targets == i)[0] for i in range(nb_classes)]
+    if not aug_data:
+        return np.zeros((0,) + data.shape[1:], dtype="uint8"), aug_label
 
-    imbal_class_indices = [
-        class_idx[:class_count]
-        for class_idx, class_count in zip(class_indices, imbal_class_counts)
-    ]
-    imbal_class_indices = np.hstack(imbal_class_indices)
+    return np.concatenate(aug_data), aug_label
 
-    train_cifar.targets = targets[imbal_class_indices]
-    train_cifar.data = train_cifar.data[imbal_class_indices]
 
-    assert len(train_cifar.targets) == len(train_cifar.data)
+class SMOTEDataset(CIFARArray):
+    """
+    Imbalanced CIFAR with SMOTE samples synthesized on the fly.
+    Only the (seed, neighbour) table is stored; every access to a synthetic
+    sample draws a fresh lambda, so each epoch sees new interpolations.
+    """
 
-    class_max = max(num_sample_per_class)
-    aug_data, aug_label = smote(
-        train_cifar.data, train_cifar.targets, nb_classes, class_max
-    )
+    def __init__(self, data, targets, n_class, n_max, transform=None, **kwargs):
+        super(SMOTEDataset, self).__init__(data, targets, transform)
+        self.n_real = len(data)
+        self.seeds, self.partners, self.aug_label = smote_pairs(
+            data, targets, n_class, n_max, **kwargs
+        )
+
+    def __len__(self):
+        return self.n_real + len(self.aug_label)
+
+    def __getitem__(self, index):
+        if index < self.n_real:
+            return super(SMOTEDataset, self).__getitem__(index)
+
+        index -= self.n_real
+        # torch RNG is re-seeded per worker and per epoch by the DataLoader
+        lam = torch.rand(1, dtype=torch.float64).item()
+        img = np.round(
+            lam * self.data[self.seeds[index]]
+            + (1 - lam) * self.data[self.partners[index]]
+        )
+        img = Image.fromarray(img.astype("uint8"))
+        target = int(self.aug_label[index])
+
+        if self.transform is not None:
+            img = self.transform(img)
+
+        return img, target
+
+
+def get_smote(
+    dataset,
+    num_sample_per_class,
+    batch_size,
+    TF_train,
+    TF_test,
+    cache_key=None,
+    lazy=False,
+    device=None,
+    augment=True,
+    legacy_distance=False,
+):
+    print("Building CV {} data loader with {} workers".format(dataset, 8))
+    ds = []
 
-    train_cifar.targets = np.concatenate((train_cifar.targets, aug_label), axis=0)
-    train_cifar.data = np.concatenate((train_cifar.data, aug_data), axis=0)
+    split = load_cifar_lt(dataset, num_sample_per_class, cache_key)
+    train_cifar = CIFARArray(split["train_data"], split["train_targets"], TF_train)
 
-    print("Augmented data num = {}".format(len(aug_label)))
-    print(train_cifar.data.shape)
+    nb_classes = get_imbalanced_cifar(train_cifar, num_sample_per_class)
 
-    train_in_loader = torch.utils.data.DataLoader(
-        train_cifar, batch_size=batch_size, shuffle=True, num_workers=8
-    )
+    class_max = max(num_sample_per_class)
+    if lazy:
+        train_cifar = SMOTEDataset(
+            train_cifar.data,
+            train_cifar.targets,
+            nb_classes,
+            class_max,
+            TF_train,
+            legacy_distance=legacy_distance,
+        )
+        print("Augmented data num = {}".format(len(train_cifar.aug_label)))
+    else:
+        aug_data, aug_label = smote(
+            train_cifar.data,
+            train_cifar.targets,
+            nb_classes,
+            class_max,
+            legacy_distance=legacy_distance,
+        )
+
+        train_cifar.targets = np.concatenate((train_cifar.targets, aug_label), axis=0)
+        train_cifar.data = np.concatenate((train_cifar.data, aug_data), axis=0)
+
+        print("Augmented data num = {}".format(len(aug_label)))
+        print(train_cifar.data.shape)
+
+    if device is not None:
+        pairs = None
+        if lazy:
+            pairs = (train_cifar.seeds, train_cifar.partners, train_cifar.aug_label)
+        train_in_loader = DeviceLoader(
+            train_cifar.data,
+            train_cifar.targets,
+            batch_size,
+            device,
+            augment=augment,
+            pairs=pairs,
+        )
+    else:
+        train_in_loader = torch.utils.data.DataLoader(
+            train_cifar, batch_size=batch_size, shuffle=True, num_workers=8
+        )
     ds.append(train_in_loader)
 
-    test_cifar = dataset_(root=DATA_ROOT, train=False, download=True, transform=TF_test)
-    val_idx, test_idx = get_val_test_data(test_cifar, num_test_samples)
-    val_loader = torch.utils.data.DataLoader(
-        test_cifar, batch_size=100, sampler=SubsetRandomSampler(val_idx), num_workers=8
-    )
-    test_loader = torch.utils.data.DataLoader(
-        test_cifar, batch_size=100, sampler=SubsetRandomSampler(test_idx), num_workers=8
-    )
+    val_loader, test_loader = get_val_test_loaders(split, TF_test)
     ds.append(val_loader)
     ds.append(test_loader)
     ds = ds[0] if len(ds) == 1 else ds
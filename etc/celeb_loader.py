@@ -1,11 +1,14 @@
 import torch.utils.data as data
 from PIL import Image
+import argparse
+import glob
 import os
 import json
 from torchvision import transforms, utils, datasets
 import random
 import numpy as np
 
+from multiprocessing import Pool
 from torch import cuda
 from torch.utils.data import Dataset, DataLoader, ConcatDataset
 from torch.utils.data.sampler import WeightedRandomSampler
@@ -28,11 +31,36 @@ data_transforms = {
     ])
 }
 
+# Packed shards are already resized, so only the augmentation remains
+packed_transforms = {
+    'train': transforms.Compose([
+        transforms.RandomCrop(image_size, padding=4),
+        transforms.RandomHorizontalFlip(),
+        transforms.ToTensor(),
+    ]),
+    'val': transforms.ToTensor(),
+    'test': transforms.ToTensor(),
+}
+
 class LT_Dataset(Dataset):
-    def __init__(self, root, txt, transform=None):
+    """
+    Long-tailed dataset listed in a txt file of "<path> <label>" lines.
+    With `shard_dir`, images are read from the uint8 shards written by
+    `build_shards` (memory-mapped) instead of decoding the JPEG files.
+    """
+    def __init__(self, root, txt, transform=None, shard_dir=None):
         self.img_path = []
         self.labels = []
         self.transform = transform
+        self.shards = None
+        if shard_dir is not None:
+            name = _shard_name(txt)
+            paths = sorted(glob.glob(os.path.join(shard_dir, name + '_[0-9]*.npy')))
+            self.shards = [np.load(p, mmap_mode='r') for p in paths]
+            self.offsets = np.cumsum([0] + [len(s) for s in self.shards])
+            self.labels = np.load(os.path.join(shard_dir, name + '_labels.npy')).tolist()
+            assert self.offsets[-1] == len(self.labels)
+            return
         with open(txt) as f:
             for line in f:
                 self.img_path.append(os.path.join(root, line.split()[0]))
@@ -42,11 +70,15 @@ class LT_Dataset(Dataset):
         return len(self.labels)
 
     def __getitem__(self, index):
-        path = self.img_path[index]
         label = self.labels[index]
 
-        with open(path, 'rb') as f:
-            sample = Image.open(f).convert('RGB')
+        if self.shards is not None:
+            shard = np.searchsorted(self.offsets, index, side='right') - 1
+            sample = Image.fromarray(np.asarray(self.shards[shard][index - self.offsets[shard]]))
+        else:
+            path = self.img_path[index]
+            with open(path, 'rb') as f:
+                sample = Image.open(f).convert('RGB')
 
         if self.transform is not None:
             sample = self.transform(sample)
@@ -54,20 +86,57 @@ class LT_Dataset(Dataset):
         return sample, label
 
 
+def _shard_name(txt):
+    return os.path.splitext(os.path.basename(txt))[0]
+
+
+def _load_resized(args):
+    path, size = args
+    with open(path, 'rb') as f:
+        sample = Image.open(f).convert('RGB')
+    # Center crop keeps every shard entry (size x size) for non-square images
+    sample = transforms.CenterCrop(size)(transforms.Resize(size)(sample))
+    return np.asarray(sample, dtype=np.uint8)
+
+
+def build_shards(root, txt, shard_dir, size=image_size, shard_size=10000, num_workers=16):
+    """
+    Decode and resize every image listed in `txt` in parallel and write them
+    as uint8 shards `<name>_<i>.npy` of shape (N, size, size, 3), plus the
+    labels as `<name>_labels.npy`, where <name> is the txt file name.
+    """
+    dataset = LT_Dataset(root, txt)
+    name = _shard_name(txt)
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    pool = Pool(num_workers)
+    for shard, start in enumerate(range(0, len(dataset), shard_size)):
+        paths = dataset.img_path[start:start + shard_size]
+        images = pool.map(_load_resized, [(p, size) for p in paths], chunksize=64)
+        np.save(os.path.join(shard_dir, '%s_%03d.npy' % (name, shard)), np.stack(images))
+        print('%s: %d / %d' % (name, start + len(paths), len(dataset)))
+    pool.close()
+    pool.join()
+
+    np.save(os.path.join(shard_dir, name + '_labels.npy'), np.asarray(dataset.labels, dtype=np.int64))
+
+
 def default_loader(path):
     return Image.open(path).convert('RGB')
 
 
-def get_celeb_loader(batch_size, mode=False, smote=False, num_workers=16):
+def get_celeb_loader(batch_size, mode=False, smote=False, num_workers=16, shard_dir=None):
     txt_train = './CelebA/celebA_train_orig.txt'
     txt_val = './CelebA/celebA_val_orig.txt'
     txt_test = './CelebA/celebA_test_orig.txt'
 
     data_root = '/home/temp/data/CelebA/'
+    tf = data_transforms if shard_dir is None else packed_transforms
 
-    set_train = LT_Dataset(data_root, txt_train, data_transforms['train'])
-    set_val = LT_Dataset(data_root, txt_val, data_transforms['val'])
-    set_test = LT_Dataset(data_root, txt_test, data_transforms['test'])
+    set_train = LT_Dataset(data_root, txt_train, tf['train'], shard_dir)
+    set_val = LT_Dataset(data_root, txt_val, tf['val'], shard_dir)
+    set_test = LT_Dataset(data_root, txt_test, tf['test'], shard_dir)
 
     train_loader = DataLoader(set_train, batch_size, shuffle=True, num_workers=num_workers,pin_memory=cuda.is_available())
     val_loader = DataLoader(set_val, batch_size, shuffle=False, num_workers=num_workers, pin_memory=cuda.is_available())
@@ -77,6 +146,15 @@ def get_celeb_loader(batch_size, mode=False, smote=False, num_workers=16):
 
 
 if __name__ == '__main__':
-
-    for mode in ["train", "val", "test"]:
-        loader = get_celeb_loader(128, mode, 4)
+    # e.g. python etc/celeb_loader.py --out /home/temp/data/CelebA/shards etc/celebA_*_orig.txt
+    parser = argparse.ArgumentParser(description='Pack txt-listed LT datasets into uint8 shards')
+    parser.add_argument('txt', nargs='+', help='txt files of "<path> <label>" lines')
+    parser.add_argument('--root', default='/home/temp/data/CelebA/', help='image root')
+    parser.add_argument('--out', required=True, help='output directory of the shards')
+    parser.add_argument('--size', default=image_size, type=int, help='image size')
+    parser.add_argument('--shard_size', default=10000, type=int, help='images per shard')
+    parser.add_argument('--workers', default=16, type=int, help='decoding processes')
+    args = parser.parse_args()
+
+    for txt in args.txt:
+        build_shards(args.root, txt, args.out, args.size, args.shard_size, args.workers)
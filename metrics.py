@@ -0,0 +1,175 @@
+"""Streaming classification metrics over an on-device confusion matrix."""
+
+import numpy as np
+import torch
+from scipy.stats import gmean
+
+
+def get_class_groups(n_class):
+    """Default class groups: the first, middle and last third of the classes."""
+    third = n_class // 3
+    classes = np.arange(n_class)
+    return {
+        "major": classes[:third],
+        "neutral": classes[third : n_class - third],
+        "minor": classes[n_class - third :],
+    }
+
+
+def get_shot_groups(num_sample_per_class, many=100, few=20):
+    """
+    Many- / medium- / few-shot classes by their training size:
+    more than `many`, between `few` and `many`, and fewer than `few` samples.
+    Empty groups ( e.g. every group but one on a balanced split ) are left out.
+    """
+    counts = np.asarray(num_sample_per_class)
+    classes = np.arange(len(counts))
+    groups = {
+        "many": classes[counts > many],
+        "medium": classes[(counts <= many) & (counts >= few)],
+        "few": classes[counts < few],
+    }
+    return {name: group for name, group in groups.items() if len(group) > 0}
+
+
+def confusion_matrix(predicted, targets, n_class):
+    """(C x C) confusion matrix of a batch, rows are targets, on its device."""
+    confusion = torch.bincount(targets * n_class + predicted, minlength=n_class**2)
+    return confusion.view(n_class, n_class)
+
+
+def batch_class_rank(targets, n_class):
+    """Rank of every target among the earlier targets of its class in a batch."""
+    counts = torch.bincount(targets, minlength=n_class)
+    starts = torch.cumsum(counts, 0) - counts
+    order = torch.sort(targets, stable=True)[1]
+    rank = torch.empty_like(order)
+    rank[order] = torch.arange(order.size(0), device=targets.device)
+    return rank - starts[targets]
+
+
+class StreamingMetrics(object):
+    """
+    Classification metrics accumulated batch by batch on the device and read
+    back once by compute(): loss, accuracy, per-class recall, balanced
+    accuracy, G-mean ( `gm` for evaluation, `train_gm` for training ),
+    macro-F1 and the accuracy of each class group.
+
+    With `per_class`, the confusion matrix ( hence everything but loss and
+    accuracy ) only counts the first `per_class` samples of each class in
+    loader order. With `reservoir`, the logits ( or the `embed` passed to
+    update() ) of those samples are kept as well.
+    """
+
+    def __init__(self, n_class, groups=None, per_class=None, reservoir=False):
+        self.n_class = n_class
+        self.groups = get_class_groups(n_class) if groups is None else groups
+        self.per_class = per_class
+        self.keep_reservoir = reservoir
+        self.total = 0
+        self.loss = None
+        self.correct = None
+        self.seen = None
+        self.confusion = None
+        self.reservoir = None
+
+    def _init(self, device):
+        n = self.n_class
+        self.loss = torch.zeros((), dtype=torch.double, device=device)
+        self.correct = torch.zeros((), dtype=torch.long, device=device)
+        self.seen = torch.zeros(n, dtype=torch.long, device=device)
+        self.confusion = torch.zeros(n, n, dtype=torch.long, device=device)
+
+    def update(self, logits, targets, loss=None, embed=None):
+        """
+        Add a batch. `loss` is either the batch mean or per-sample losses;
+        `embed` replaces the logits in the reservoir.
+        """
+        if self.confusion is None:
+            self._init(logits.device)
+        batch_size = targets.size(0)
+        logits = logits.detach()
+        predicted = logits.max(1)[1]
+
+        if loss is not None:
+            loss = loss.detach().double()
+            # Same as summing loss.item() * batch_size in Python floats
+            self.loss += loss * batch_size if loss.dim() == 0 else loss.sum()
+        self.correct += predicted.eq(targets).sum()
+        self.total += batch_size
+
+        if self.per_class is None and not self.keep_reservoir:
+            self.confusion += confusion_matrix(predicted, targets, self.n_class)
+            return
+
+        rank = self.seen[targets] + batch_class_rank(targets, self.n_class)
+        take = torch.ones_like(targets, dtype=torch.bool)
+        if self.per_class is not None:
+            take = rank < self.per_class
+        self.seen += torch.bincount(targets, minlength=self.n_class)
+        self.confusion += confusion_matrix(predicted[take], targets[take], self.n_class)
+
+        if self.keep_reservoir:
+            embed = logits if embed is None else embed.detach().float()
+            if self.reservoir is None:
+                self.reservoir = embed.new_zeros(
+                    self.n_class, self.per_class, embed.size(1)
+                )
+            self.reservoir[targets[take], rank[take]] = embed[take]
+
+    def compute(self):
+        """Read the metrics back ( in % ) in one go."""
+        if self.confusion is None:
+            self._init("cpu")
+        confusion = self.confusion.cpu()
+        class_correct = confusion.diag().float()
+        class_total = confusion.sum(1).float()
+        predicted_total = confusion.sum(0).float()
+
+        recall = class_correct / class_total
+        precision = class_correct / predicted_total
+        f1 = 2 * precision * recall / (precision + recall)
+        f1[torch.isnan(f1)] = 0
+
+        # Balanced accuracy and G-mean over the classes that have samples:
+        # evaluation's G-mean over the non-zero recalls, training's over all
+        # of them plus 1e-10; macro-F1 over the classes that have samples or
+        # predictions
+        present = class_total > 0
+        f1 = f1[present | (predicted_total > 0)]
+        recall = recall[present].double().numpy()
+
+        correct = self.correct.item()
+        total = self.total
+        results = {
+            "acc": 100.0 * correct / total,
+            "correct": correct,
+            "total": total,
+            "class_acc": 100.0 * class_correct / class_total,
+            "bal_acc": 100.0 * np.mean(recall),
+            "gm": 100.0 * gmean(recall[recall.nonzero()]),
+            "train_gm": 100.0 * gmean(recall + 1e-10),
+            "f1_score": 100.0 * f1.mean().item(),
+            "confusion": confusion.numpy(),
+            "groups": [],
+        }
+        if self.loss is not None:
+            results["loss"] = self.loss.item() / max(total, 1)
+
+        # Groups without samples are left out of the results
+        for name, classes in self.groups.items():
+            classes = torch.as_tensor(classes, dtype=torch.long)
+            group_total = float(confusion[classes].sum())
+            group_correct = float(confusion.diag()[classes].sum())
+            if group_total:
+                results["groups"].append(name)
+                results[name + "_acc"] = 100.0 * group_correct / group_total
+
+        if self.reservoir is not None:
+            filled = torch.clamp(self.seen, max=self.per_class).cpu().numpy()
+            reservoir = self.reservoir.cpu().numpy()
+            results["embed"] = np.concatenate(
+                [reservoir[c, : filled[c]] for c in range(self.n_class)]
+            )
+            results["embed_targets"] = np.repeat(np.arange(self.n_class), filled)
+        return results
@@ -1 +1,2 @@
 from .resnet32 import *
+from .batched import BatchedCifarResNet
@@ -0,0 +1,159 @@
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .resnet32 import DownsampleA, NormedLinear
+
+
+class BatchedDownsampleA(nn.Module):
+    """DownsampleA of K models whose channels are stacked model by model."""
+
+    def __init__(self, n_models, stride):
+        super(BatchedDownsampleA, self).__init__()
+        self.n_models = n_models
+        self.avg = nn.AvgPool2d(kernel_size=1, stride=stride)
+
+    def forward(self, x):
+        x = self.avg(x)
+        n, c, h, w = x.shape
+        x = x.view(n, self.n_models, c // self.n_models, h, w)
+        return torch.cat((x, x.mul(0)), 2).view(n, 2 * c, h, w)
+
+
+class BatchedLinear(nn.Module):
+    """
+    K Linear ( or NormedLinear ) heads, each applied to the features of its
+    own model. Maps (N, K * in_features) to (N, K, out_features).
+    """
+
+    def __init__(self, n_models, in_features, out_features, normalized=False):
+        super(BatchedLinear, self).__init__()
+        self.n_models = n_models
+        self.normalized = normalized
+        if normalized:
+            shape = (n_models, in_features, out_features)
+            self.weight = nn.Parameter(torch.empty(shape))
+        else:
+            shape = (n_models, out_features, in_features)
+            self.weight = nn.Parameter(torch.empty(shape))
+            self.bias = nn.Parameter(torch.empty(n_models, out_features))
+
+    def forward(self, x):
+        x = x.view(x.size(0), self.n_models, -1)
+        if self.normalized:
+            x, weight = F.normalize(x, dim=2), F.normalize(self.weight, dim=1)
+            return torch.einsum("nki,kio->nko", x, weight)
+        return torch.einsum("nki,koi->nko", x, self.weight) + self.bias
+
+
+class BatchedCifarResNet(nn.Module):
+    """
+    K CifarResNet of the same architecture fused into one wide network, to
+    train them in lockstep: convolutions are grouped by model and batch
+    norms span the channels of all models, so that every model keeps its own
+    weights, batch statistics and gradients.
+
+    Inputs are (N, K, C, H, W), one batch per model, and logits are
+    (N, K, num_classes). The models are copied in by the constructor and
+    read back with model_state_dict(k), in the format of CifarResNet.
+    """
+
+    def __init__(self, nets):
+        super(BatchedCifarResNet, self).__init__()
+        self.n_models = len(nets)
+        net = copy.deepcopy(nets[0])
+        for name, module in list(net.named_modules()):
+            batched = self._batched(module)
+            if batched is not None:
+                parent, _, attr = name.rpartition(".")
+                setattr(net.get_submodule(parent), attr, batched)
+        self.net = net
+
+        states = [n.state_dict() for n in nets]
+        self.shapes = {key: value.shape for key, value in states[0].items()}
+        fused = net.state_dict()
+        net.load_state_dict(
+            {
+                key: self._merge(fused[key], [state[key] for state in states])
+                for key in fused
+            }
+        )
+
+    def _batched(self, module):
+        k = self.n_models
+        if isinstance(module, nn.Conv2d):
+            return nn.Conv2d(
+                k * module.in_channels,
+                k * module.out_channels,
+                kernel_size=module.kernel_size,
+                stride=module.stride,
+                padding=module.padding,
+                bias=module.bias is not None,
+                groups=k * module.groups,
+            )
+        if isinstance(module, nn.BatchNorm2d):
+            return nn.BatchNorm2d(
+                k * module.num_features,
+                eps=module.eps,
+                momentum=module.momentum,
+                affine=module.affine,
+                track_running_stats=module.track_running_stats,
+            )
+        if isinstance(module, DownsampleA):
+            return BatchedDownsampleA(k, module.avg.stride)
+        if isinstance(module, nn.Linear):
+            return BatchedLinear(k, module.in_features, module.out_features)
+        if isinstance(module, NormedLinear):
+            in_features, out_features = module.weight.shape
+            return BatchedLinear(k, in_features, out_features, normalized=True)
+        return None
+
+    @staticmethod
+    def _merge(fused, tensors):
+        if fused.dim() == 0:  # num_batches_tracked, the same for all models
+            return tensors[0]
+        if fused.dim() == tensors[0].dim() + 1:  # heads
+            return torch.stack(tensors)
+        return torch.cat(tensors)  # channels of grouped convs and batch norms
+
+    def split(self, key, fused, k):
+        """The part of model k of `fused`, a state ( or per-parameter ) tensor."""
+        shape = self.shapes[key]
+        if fused.dim() == 0:
+            return fused.clone()
+        if fused.dim() == len(shape) + 1:
+            return fused[k].clone()
+        return fused.chunk(self.n_models)[k].clone()
+
+    def model_state_dict(self, k):
+        """The state dict of model k, loadable by a CifarResNet."""
+        return {
+            key: self.split(key, value, k)
+            for key, value in self.net.state_dict().items()
+        }
+
+    def model_optimizer_state(self, optimizer, k):
+        """
+        The state dict of an optimizer of model k alone, from `optimizer` over
+        the fused parameters ( per-parameter states such as SGD momentum are
+        element-wise, hence split like the parameters ).
+        """
+        names = [name for name, _ in self.net.named_parameters()]
+        state = optimizer.state_dict()
+        state["state"] = {
+            i: {
+                key: (
+                    self.split(names[i], value, k)
+                    if torch.is_tensor(value) and value.dim() > 0
+                    else value
+                )
+                for key, value in param_state.items()
+            }
+            for i, param_state in state["state"].items()
+        }
+        return state
+
+    def forward(self, x):
+        return self.net(x.flatten(1, 2))
@@ -0,0 +1,112 @@
+"""
+Run several train.py configurations in one process ( or a small pool ).
+
+    python sweep.py 100_100.sh
+    python sweep.py configs.txt --workers 2
+
+In a .sh file, every line that calls train.py gives the arguments of one run;
+in any other file, every non-empty line does ( optionally prefixed by
+`python train.py` ). Each run executes train.py as __main__ with its
+arguments, hence writes the same log dir and CSV rows as a separate
+`python train.py` call. Imports, CIFAR splits ( see load_cifar_lt ) and
+net_g checkpoints ( see load_checkpoint ) are loaded once per process.
+"""
+
+import argparse
+import gc
+import multiprocessing
+import os
+import runpy
+import shlex
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+TRAIN_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "train.py")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="In-process sweep of train.py runs")
+    parser.add_argument(
+        "configs", nargs="+", help="Scripts or files with train.py arguments"
+    )
+    parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="Worker processes; each one keeps its own data and checkpoints",
+    )
+    return parser.parse_args()
+
+
+def read_configs(path):
+    """Argument lists of the runs of a configuration file."""
+    configs = []
+    with open(path) as f:
+        # Join the lines continued with a trailing backslash
+        lines = f.read().replace("\\\n", " ").splitlines()
+    for line in lines:
+        tokens = [os.path.expandvars(t) for t in shlex.split(line, comments=True)]
+        calls = [i for i, t in enumerate(tokens) if t.endswith("train.py")]
+        if calls:
+            configs.append(tokens[calls[0] + 1 :])
+        elif tokens and not path.endswith(".sh"):
+            configs.append(tokens)
+    return configs
+
+
+def _finish_wandb(ok):
+    # train.py only finishes its wandb run when it completes
+    wandb = sys.modules.get("wandb")
+    if wandb is not None and wandb.run is not None:
+        wandb.finish(exit_code=0 if ok else 1)
+
+
+def run_config(argv):
+    """Run train.py with the arguments `argv` in this process."""
+    # config.py parses sys.argv when imported, so it is imported again per run
+    sys.modules.pop("config", None)
+    sys.argv = [TRAIN_PY] + list(argv)
+    start = time.time()
+    try:
+        runpy.run_path(TRAIN_PY, run_name="__main__")
+        ok = True
+    except SystemExit as e:  # e.g. after --export_gen
+        ok = e.code in (None, 0)
+    except Exception:
+        traceback.print_exc()
+        ok = False
+    _finish_wandb(ok)
+
+    # Release the models of the finished run before the next one
+    gc.collect()
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return ok, time.time() - start
+
+
+def _run_name(argv):
+    return argv[argv.index("--name") + 1] if "--name" in argv[:-1] else " ".join(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    configs = [argv for path in args.configs for argv in read_configs(path)]
+    print("==> Sweep of %d runs" % len(configs))
+
+    if args.workers > 1:
+        # CUDA cannot be used in forked children
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(args.workers, mp_context=context) as pool:
+            results = list(pool.map(run_config, configs))
+    else:
+        results = [run_config(argv) for argv in configs]
+
+    print("==> Sweep results")
+    for argv, (ok, seconds) in zip(configs, results):
+        status = "ok" if ok else "FAILED"
+        print("%-8s %10.1fs  %s" % (status, seconds, _run_name(argv)))
+    if not all(ok for ok, _ in results):
+        sys.exit(1)
@@ -0,0 +1,37 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from utils import TranslationStore
+
+
+def _images(values):
+    return torch.tensor(values, dtype=torch.float).view(-1, 1, 1, 1)
+
+
+def test_put_misses_never_take_the_slot_of_a_hit():
+    store = TranslationStore(8, 1, 2, (1, 1, 1), dtype="half")
+    store.lookup(torch.tensor([0, 1]))
+    store.put(torch.tensor([0, 1]), _images([0.25, 0.5]))
+
+    # Key 0 is a hit; keys 2 and 3 miss but only one slot is left for them
+    store.lookup(torch.tensor([0, 2, 3]))
+    store.put(torch.tensor([0, 2, 3]), _images([0.75, 0.125, 0.375]))
+
+    hit, slots = store.lookup(torch.tensor([0, 1, 2, 3]))
+    assert hit.tolist() == [True, False, True, False]
+    assert store.get(slots[hit]).view(-1).tolist() == [0.75, 0.125]
+    assert store.key_of[slots[hit]].tolist() == [0, 2]
+
+
+def test_put_keeps_at_most_capacity_keys():
+    store = TranslationStore(8, 1, 3, (1, 1, 1), dtype="half")
+    keys = torch.arange(5)
+    store.lookup(keys)
+    store.put(keys, _images([0.0, 0.125, 0.25, 0.375, 0.5]))
+
+    hit, slots = store.lookup(keys)
+    assert int(hit.sum()) == 3
+    assert sorted(store.key_of.tolist()) == keys[hit].tolist()
+    for key, slot in zip(keys[hit].tolist(), slots[hit].tolist()):
+        assert store.get(torch.tensor([slot])).item() == key / 8
@@ -6,8 +6,10 @@
 # the root directory of this source tree.
 from __future__ import print_function
 
-import csv
+import copy
+import math
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import matplotlib.pyplot as plt
 
@@ -18,19 +20,21 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from config import *
-from imblearn.metrics import geometric_mean_score
-from scipy.stats import gmean
-from sklearn.metrics import balanced_accuracy_score, precision_score, recall_score
-from torch.autograd import Variable, grad
+from metrics import StreamingMetrics
 from tqdm import tqdm
 from utils import (
-    FocalLoss,
-    LDAMLoss,
+    GenerationStore,
     Logger,
+    TranslationStore,
     classwise_loss,
+    dual_forward,
+    dual_input_grad,
+    file_hash,
     inf_data_gen,
+    load_checkpoint,
     make_step,
     random_perturb,
+    save_embedding,
     soft_cross_entropy,
 )
 
@@ -39,29 +43,7 @@ logger = Logger(LOGNAME)
 LOGDIR = logger.logdir
 
 LOG_CSV = os.path.join(LOGDIR, f"log_{SEED}.csv")
-LOG_CSV_HEADER = [
-    "epoch",
-    "train loss",
-    "gen loss",
-    "train acc",
-    "gen_acc",
-    "prob_orig",
-    "prob_targ",
-    "train bal acc",
-    "train gm",
-    "test loss",
-    "major test acc",
-    "neutral test acc",
-    "minor test acc",
-    "test acc",
-    "f1 score",
-    "test gm",
-    "test bal acc",
-]
-if not os.path.exists(LOG_CSV):
-    with open(LOG_CSV, "w") as f:
-        csv_writer = csv.writer(f, delimiter=",")
-        csv_writer.writerow(LOG_CSV_HEADER)
+init_log_csv(LOG_CSV)
 
 
 def save_checkpoint(acc, model, optim, epoch, index=False):
@@ -86,88 +68,57 @@ def save_checkpoint(acc, model, optim, epoch, index=False):
 
     ckpt_path = os.path.join(LOGDIR, ckpt_name)
     torch.save(state, ckpt_path)
-    if (
-        ARGS.name == "ERM"
-        or ARGS.name == "LDAM"
-        or ARGS.name == "ERM-M2m"
-        or ARGS.name == "LDAM-M2m"
-    ):
-        file_name = f"/home/ubuntu/M2m/checkpoint/{ARGS.name}_{ARGS.model}_{ARGS.dataset}_{ARGS.ratio}.t7"
-        if not os.path.exists(file_name):
-            torch.save(state, file_name)
-        if epoch == ARGS.warm - 1:
-            file_name = f"/home/ubuntu/M2m/checkpoint/{ARGS.name}_{ARGS.model}_{ARGS.dataset}_{ARGS.ratio}_warm.t7"
-            torch.save(state, file_name)
+    save_reference_checkpoint(state, epoch)
+
+
+def is_embed_epoch(epoch):
+    return ARGS.embed_every > 0 and (epoch + 1) % ARGS.embed_every == 0
+
+
+# Embedding snapshots are projected and plotted in a background process
+EMBED_POOL = ProcessPoolExecutor(max_workers=1) if ARGS.embed_every > 0 else None
 
 
 def train_epoch(model, criterion, optimizer, data_loader, logger=None):
     model.train()
 
-    train_loss = 0
-    correct = 0
-    total = 0
-
-    all_targets = []
-    all_predicted = []
-    all_outputs = []
-    class_counts = {}
+    snapshot = is_embed_epoch(epoch)
+    # Balanced accuracy, G-mean and the embedding reservoir cover the first
+    # 50 samples of each class in loader order
+    metrics = StreamingMetrics(
+        N_CLASSES, CLASS_GROUPS, per_class=50, reservoir=snapshot
+    )
 
-    for inputs, targets in tqdm(data_loader):
+    for batch in tqdm(data_loader):
+        inputs, targets = batch[0], batch[1]
         # For SMOTE, get the samples from smote_loader instead of usual loader
         if epoch >= ARGS.warm and ARGS.smote:
             inputs, targets = next(smote_loader_inf)
 
         inputs, targets = inputs.to(device), targets.to(device)
-        batch_size = inputs.size(0)
 
-        outputs, _ = model(normalizer(inputs))
+        with autocast():
+            outputs, features = model(normalizer(inputs))
+        # Losses are computed in fp32 from the ( possibly reduced ) logits
+        outputs = outputs.float()
         loss = criterion(outputs, targets).mean()
-
-        train_loss += loss.item() * batch_size
-        predicted = outputs.max(1)[1]
-        total += batch_size
-        correct += sum_t(predicted.eq(targets))
-
-        for target, prediction, output in zip(
-            targets.cpu().numpy(),
-            predicted.cpu().numpy(),
-            outputs.detach().cpu().numpy(),
-        ):
-            if class_counts.get(target, 0) < 50:
-                all_targets.append(target)
-                all_predicted.append(prediction)
-                all_outputs.append(output)
-                class_counts[target] = class_counts.get(target, 0) + 1
+        # The penultimate features are the last of CifarResNet's feature list
+        embed = features[-1] if ARGS.embed_source == "features" else None
+        metrics.update(outputs, targets, loss, embed)
 
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-
-    all_targets = np.array(all_targets)
-    all_predicted = np.array(all_predicted)
-    all_outputs = np.array(all_outputs)
-    # Get unique classes
-    classes = np.unique(all_targets)
-
-    # Calculate recall for each class
-    recalls = [
-        recall_score(all_targets == cls, all_predicted == cls) + 1e-10
-        for cls in classes
-    ]
-
-    # Calculate balanced accuracy
-    bal_acc_score = np.mean(recalls)
-
-    # Calculate geometric mean score
-    gmean_score = gmean(recalls)
+        SCALER.scale(loss).backward()
+        SCALER.step(optimizer)
+        SCALER.update()
 
+    results = metrics.compute()
     msg = "Loss: %.3f| Acc: %.3f%% (%d/%d) | GMean: %.3f | BalAcc: %.3f" % (
-        train_loss / total,
-        100.0 * correct / total,
-        correct,
-        total,
-        100.0 * gmean_score,
-        100.0 * bal_acc_score,
+        results["loss"],
+        results["acc"],
+        results["correct"],
+        results["total"],
+        results["train_gm"],
+        results["bal_acc"],
     )
 
     if logger:
@@ -175,34 +126,17 @@ def train_epoch(model, criterion, optimizer, data_loader, logger=None):
     else:
         print(msg)
 
-    # Apply t-SNE to the outputs
-    tsne = TSNE(n_components=2, random_state=42)
-    outputs_tsne = tsne.fit_transform(all_outputs)
-
-    # Plot the t-SNE results
-    plt.figure(figsize=(10, 8))
-    for class_index in classes:
-        idxs = [i for i, x in enumerate(all_targets) if x == class_index]
-        if len(idxs) > 50:
-            idxs = np.random.choice(idxs, 50, replace=False)
-        plt.scatter(
-            outputs_tsne[idxs, 0], outputs_tsne[idxs, 1], label=f"Class {class_index}"
+    if snapshot:
+        EMBED_POOL.submit(
+            save_embedding,
+            results["embed"],
+            results["embed_targets"],
+            os.path.join(LOGDIR, "embedding_%s_%d.png" % (ARGS.embed_source, epoch)),
+            ARGS.embed_method,
+            "Training set %s, epoch %d" % (ARGS.embed_source, epoch),
         )
 
-    plt.legend()
-    plt.title("t-SNE of Training Set Outputs")
-    plt.grid(True)
-    plt.gca().axes.get_xaxis().set_visible(False)
-    plt.gca().axes.get_yaxis().set_visible(False)
-    plt.savefig("train_set_decision_boundary.png")
-    plt.close()
-
-    return (
-        train_loss / total,
-        100.0 * correct / total,
-        100.0 * bal_acc_score,
-        100.0 * gmean_score,
-    )
+    return results["loss"], results["acc"], results["bal_acc"], results["train_gm"]
 
 
 def uniform_loss(outputs):
@@ -217,6 +151,39 @@ def classwise_loss(outputs, targets):
     return (outputs * out_1hot).sum(1).mean()
 
 
+# Attack steps run in this epoch, those of the extra attempts of an
+# AttackBudget, and those saved against ARGS.attack_iter steps per generation
+# slot, added up on the main thread by add_gen_stats
+GEN_STATS = {"steps": 0, "extra": 0, "saved": 0}
+
+GEN_CRITERION = nn.CrossEntropyLoss()
+_GEN_STREAMS = {}
+_GEN_COMPILED = {}
+
+
+def _gen_stream(model_g, model_r, device):
+    """Side stream that runs model_r next to model_g on CUDA."""
+    if device.type != "cuda":
+        return None
+    if isinstance(model_g, nn.DataParallel) or isinstance(model_r, nn.DataParallel):
+        return None
+    if device not in _GEN_STREAMS:
+        _GEN_STREAMS[device] = torch.cuda.Stream(device)
+    return _GEN_STREAMS[device]
+
+
+def _gen_model(model):
+    """The model compiled for the attack step with --gen_compile."""
+    if not ARGS.gen_compile or not hasattr(torch, "compile"):
+        return model
+    if model not in _GEN_COMPILED:
+        # CUDA graphs remove the launch overhead of the small ResNets
+        is_cuda = next(model.parameters()).is_cuda
+        mode = "reduce-overhead" if is_cuda else None
+        _GEN_COMPILED[model] = torch.compile(model, mode=mode)
+    return _GEN_COMPILED[model]
+
+
 def generation(
     model_g,
     model_r,
@@ -229,31 +196,95 @@ def generation(
     step_size,
     random_start=True,
     max_iter=10,
+    early_exit=False,
+    normalize=None,
+    budget=None,
 ):
     model_g.eval()
     model_r.eval()
-    criterion = nn.CrossEntropyLoss()
+    if normalize is None:
+        normalize = normalizer
+    step_g, step_r = _gen_model(model_g), _gen_model(model_r)
+    stream = _gen_stream(model_g, model_r, inputs.device)
 
     if random_start:
         random_noise = random_perturb(inputs, "l2", 0.5)
         inputs = torch.clamp(inputs + random_noise, 0, 1)
 
-    for _ in range(max_iter):
-        inputs = inputs.clone().detach().requires_grad_(True)
-        outputs_g, _ = model_g(normalizer(inputs))
-        outputs_r, _ = model_r(normalizer(inputs))
+    # With early exit, samples whose g-confidence on the target already
+    # reaches gamma are frozen and dropped from the active sub-batch.
+    # Models are in eval mode and make_step normalizes every gradient per
+    # sample, so the remaining samples follow steps that are numerically
+    # equivalent up to float error ( the loss is averaged over fewer
+    # samples, which only rescales their gradients before normalization ).
+    # An AttackBudget gives every sample its own number of steps and step
+    # size, and records after how many steps it first reached gamma.
+    # The steps and the budget observation are returned rather than
+    # recorded, as generation may run on a GenerationPipeline thread.
+    subset = early_exit or budget is not None
+    if budget is not None:
+        sample_iters, sample_steps = budget.plan(targets, max_iter, step_size)
+        reached = torch.full_like(targets, -1)
+        num_run = torch.zeros_like(targets)
+    active = torch.arange(inputs.size(0), device=inputs.device)
+    num_steps = 0
+
+    for it in range(max_iter):
+        x = inputs[active].clone().detach()
+        with autocast(inputs.device.type):
+            outputs_g, outputs_r, x_g, x_r = dual_forward(
+                step_g, step_r, normalize, x, stream
+            )
+        outputs_g, outputs_r = outputs_g.float(), outputs_r.float()
+        targets_a, seed_targets_a = targets[active], seed_targets[active]
+
+        if subset:
+            probs = torch.softmax(outputs_g.detach(), dim=1)
+            confident = probs.gather(1, targets_a.view(-1, 1)).view(-1) >= gamma
+            running = ~confident
+            if budget is not None:
+                reached[active[confident & (reached[active] < 0)]] = it
+                running = sample_iters[active] > it
+                if early_exit:
+                    running &= ~confident
+            if not running.any():
+                break
+            active = active[running]
+            outputs_g, outputs_r = outputs_g[running], outputs_r[running]
+            targets_a, seed_targets_a = targets_a[running], seed_targets_a[running]
 
-        loss = criterion(outputs_g, targets) + lam * classwise_loss(
-            outputs_r, seed_targets
+        loss = GEN_CRITERION(outputs_g, targets_a) + lam * classwise_loss(
+            outputs_r, seed_targets_a
         )
-        (grad,) = torch.autograd.grad(loss, [inputs])
-
-        inputs = inputs - make_step(grad, "l2", step_size)
-        inputs = torch.clamp(inputs, 0, 1)
-
+        if AMP_DTYPE == torch.float16:
+            # Per-sample gradients at sum scale keep fp16 activations' gradients
+            # from underflowing; make_step normalizes them anyway.
+            loss = loss * x.size(0)
+        grad = dual_input_grad(loss, x_g, x_r, normalize)
+        if subset:
+            x, grad = x[running], grad[running]
+
+        step = step_size
+        if budget is not None:
+            step = sample_steps[active].view(-1, 1, 1, 1)
+            num_run[active] += 1
+        inputs = inputs.detach().clone()
+        inputs[active] = torch.clamp(x - make_step(grad, "l2", step), 0, 1)
+        num_steps += active.size(0)
+
+    stats = {
+        "steps": num_steps,
+        "extra": 0,
+        "saved": inputs.size(0) * max_iter - num_steps,
+        "observed": None,
+        # Steps run per sample, with an AttackBudget
+        "sample_steps": num_run if budget is not None else None,
+    }
     inputs = inputs.detach()
 
-    outputs_g, _ = model_g(normalizer(inputs))
+    with autocast(inputs.device.type):
+        outputs_g, _ = model_g(normalize(inputs))
+    outputs_g = outputs_g.float()
 
     one_hot = torch.zeros_like(outputs_g)
     one_hot.scatter_(1, targets.view(-1, 1), 1)
@@ -261,163 +292,880 @@ def generation(
     flag = (ARGS.ratio == 1) and (ARGS.imb_type == "none")
 
     if flag == True:
-        correct = torch.ones_like(torch.bernoulli(p_accept).byte()).to(device)
+        correct = torch.ones_like(torch.bernoulli(p_accept).byte())
     elif flag == False:
-        correct = (probs_g >= gamma) * torch.bernoulli(p_accept).byte().to(device)
+        correct = (probs_g >= gamma) * torch.bernoulli(p_accept).byte()
+    if budget is not None:
+        reached = torch.where(reached >= 0, reached, num_run)
+        stats["observed"] = (seed_targets, targets, probs_g >= gamma, reached)
     model_r.train()
 
-    return inputs, correct
+    return inputs, correct, stats
+
+
+def add_gen_stats(gen_stats, budget=None):
+    """
+    Add the stats returned by generation() calls to GEN_STATS and record
+    their attacks in `budget`. Only called from the main thread.
+    """
+    for stats in gen_stats:
+        for key in ["steps", "extra", "saved"]:
+            GEN_STATS[key] += stats[key]
+        if budget is not None and stats["observed"] is not None:
+            budget.observe(*stats["observed"])
+
+
+def get_accept_table(n_samples_per_class, beta):
+    """
+    Return the (C x C) table of p_accept[t, c] = 1 - beta^max(N_c - N_t, 0),
+    the acceptance probability of a seed of class c for target class t.
+    """
+    n = torch.as_tensor(n_samples_per_class, dtype=torch.float)
+    return 1 - beta ** F.relu(n.view(1, -1) - n.view(-1, 1))
+
+
+ACCEPT_TABLE = get_accept_table(N_SAMPLES_PER_CLASS_T, ARGS.beta)
+
+
+def sample_seeds(targets_orig, gen_targets, accept_table):
+    """
+    Pick a seed in the batch for every generation target, with probability
+    proportional to accept_table[target, seed class]. A seed class is drawn
+    first ( weighted by its count in the batch ), then a seed uniformly
+    within that class, which gives the same distribution as a multinomial
+    over the ( len(gen_targets) x batch_size ) acceptance matrix.
+    Returns the mask of targets with any valid seed, the seed indices and
+    their p_accept.
+    """
+    counts = torch.bincount(targets_orig, minlength=accept_table.size(1))
+    class_weights = accept_table[gen_targets] * counts.float()
+    mask_valid = class_weights.sum(1) > 0
+
+    seed_class = torch.multinomial(class_weights[mask_valid], 1, replacement=True)
+    seed_class = seed_class.view(-1)
+    p_accept = accept_table[gen_targets[mask_valid], seed_class]
+
+    # Batch positions grouped by class, then a uniform offset inside the group
+    order = torch.argsort(targets_orig)
+    starts = torch.cumsum(counts, 0) - counts
+    offset = torch.rand(seed_class.size(0), device=seed_class.device)
+    offset = (offset * counts[seed_class]).long()
+    select_idx = order[starts[seed_class] + offset]
+
+    return mask_valid, select_idx, p_accept
+
+
+class SeedIndex(object):
+    """
+    Seeds of the training set ranked once by the frozen g. For every (seed
+    class, target class) pair it keeps the `top_k` seeds of that class with
+    the highest g-probability of the target, i.e. the ones closest to it
+    under g. sample() draws the seed class with the weights of sample_seeds,
+    counted over the training set instead of the batch, then a seed
+    uniformly among the ranked ones. Seeds are un-augmented images.
+    """
+
+    def __init__(self, net_g, data_loader, accept_table, top_k=100, batch_size=1000):
+        images, targets = get_train_images(data_loader)
+        self.images, self.targets = images.to(device), targets.to(device)
+        self.accept_table = accept_table.to(device)
+        n_class = self.accept_table.size(0)
+
+        is_training = net_g.training
+        net_g.eval()
+        probs = []
+        with torch.no_grad():
+            for i in range(0, len(self.images), batch_size):
+                outputs, _ = net_g(normalizer(self.get(slice(i, i + batch_size))))
+                probs.append(torch.softmax(outputs, 1))
+        probs = torch.cat(probs)
+        net_g.train(is_training)
+
+        self.counts = torch.bincount(self.targets, minlength=n_class)
+        self.top_k = torch.clamp(self.counts, max=top_k)
+        self.ranked = torch.zeros(
+            n_class, n_class, top_k, dtype=torch.long, device=device
+        )
+        for c in range(n_class):
+            members = (self.targets == c).nonzero().view(-1)
+            k = int(self.top_k[c])
+            if k > 0:
+                rank = torch.topk(probs[members], k, dim=0)[1]
+                self.ranked[c, :, :k] = members[rank].t()
+
+    def to(self, device):
+        index = copy.copy(self)
+        for name in ["images", "targets", "accept_table", "counts", "top_k", "ranked"]:
+            setattr(index, name, getattr(self, name).to(device))
+        return index
+
+    def get(self, seed_idx):
+        return self.images[seed_idx].float().div_(255)
+
+    def sample(self, gen_targets, accept_table=None):
+        """Return the mask of targets with any valid seed, the seeds and p_accept."""
+        if accept_table is None:
+            accept_table = self.accept_table
+        class_weights = accept_table[gen_targets] * self.counts.float()
+        mask_valid = class_weights.sum(1) > 0
+        gen_targets = gen_targets[mask_valid]
+
+        seed_class = torch.multinomial(class_weights[mask_valid], 1, replacement=True)
+        seed_class = seed_class.view(-1)
+        p_accept = accept_table[gen_targets, seed_class]
+
+        rank = torch.rand(seed_class.size(0), device=seed_class.device)
+        rank = (rank * self.top_k[seed_class]).long()
+        seed_idx = self.ranked[seed_class, gen_targets, rank]
+
+        return mask_valid, seed_idx, p_accept
+
+
+class AttackBudget(object):
+    """
+    Per-class attack budget for --adaptive_budget, driven by running ( EMA
+    over attacks ) statistics of each target class:
+    - attack_iter: one more than the steps its accepted translations needed
+      to reach gamma, or the full budget while it accepts less than half;
+    - step size: scaled up to `max_step_scale` as its acceptance drops
+      below one half;
+    - attempts: seeds attacked per generation slot, enough to fill the slot
+      with probability 0.9 at its acceptance rate, up to `max_attempts`.
+    (target class, seed class) pairs that accepted nothing in `min_tries`
+    attacks are hopeless and no longer sampled; g is frozen, so they stay
+    disabled. Acceptance is the gamma gate, before the p_accept draw.
+    """
+
+    def __init__(
+        self,
+        accept_table,
+        max_iter,
+        momentum=0.9,
+        min_tries=50,
+        max_attempts=3,
+        max_step_scale=2.0,
+    ):
+        n_class = accept_table.size(0)
+        self.base_table = accept_table.to(device)
+        self.max_iter = max_iter
+        self.momentum = momentum
+        self.min_tries = min_tries
+        self.max_attempts = max_attempts
+        self.max_step_scale = max_step_scale
+
+        # Optimistic start: full budget and a single attempt
+        self.rate = torch.ones(n_class, device=device)
+        self.needed = torch.full((n_class,), float(max_iter), device=device)
+        self.pair_tries = torch.zeros(n_class, n_class, device=device)
+        self.pair_hits = torch.zeros(n_class, n_class, device=device)
+        self.epoch_tries = torch.zeros(n_class, device=device)
+        self.epoch_hits = torch.zeros(n_class, device=device)
+
+    def hopeless(self):
+        return (self.pair_tries >= self.min_tries) & (self.pair_hits == 0)
+
+    def accept_table(self):
+        return self.base_table * (~self.hopeless()).float()
+
+    def iters(self):
+        iters = torch.clamp(torch.ceil(self.needed) + 1, max=self.max_iter)
+        iters[self.rate < 0.5] = self.max_iter
+        return iters.long()
+
+    def step_scale(self):
+        return 1 + (self.max_step_scale - 1) * F.relu(1 - 2 * self.rate)
+
+    def attempts(self):
+        rate = self.rate.clamp(1e-6, 1 - 1e-6)
+        attempts = torch.ceil(math.log(0.1) / torch.log1p(-rate))
+        return attempts.clamp(1, self.max_attempts).long()
+
+    def plan(self, targets, max_iter, step_size):
+        """Per-sample attack steps and step sizes for generation targets."""
+        t = targets.to(device)
+        iters = self.iters().clamp(max=max_iter)[t]
+        steps = step_size * self.step_scale()[t]
+        return iters.to(targets.device), steps.to(targets.device)
+
+    def observe(self, seed_targets, targets, passed, reached):
+        """
+        Record attacks: passed the gamma gate, after `reached` steps. The
+        state is replaced rather than updated in place, as a GenerationPipeline
+        thread may be reading it.
+        """
+        n = self.rate.size(0)
+        t, c = targets.to(device), seed_targets.to(device)
+        passed, reached = passed.to(device), reached.to(device).float()
+
+        tries = torch.bincount(t, minlength=n).float()
+        hits = torch.bincount(t, weights=passed.float(), minlength=n)
+        pair = t * n + c
+        pair_tries = torch.bincount(pair, minlength=n * n).view(n, n)
+        pair_hits = torch.bincount(pair, weights=passed.float(), minlength=n * n)
+        self.pair_tries = self.pair_tries + pair_tries
+        self.pair_hits = self.pair_hits + pair_hits.view(n, n)
+        self.epoch_tries += tries
+        self.epoch_hits += hits
+
+        m = self.momentum
+        rate = hits / tries.clamp(min=1)
+        self.rate = torch.where(tries > 0, m * self.rate + (1 - m) * rate, self.rate)
+        needed = torch.zeros(n, device=device).scatter_reduce(
+            0, t[passed], reached[passed], "amax", include_self=False
+        )
+        self.needed = torch.where(
+            hits > 0, m * self.needed + (1 - m) * needed, self.needed
+        )
 
+    def epoch_summary(self):
+        """Per-class acceptance of this epoch and the current budget."""
+        summary = {
+            "accept": (self.epoch_hits / self.epoch_tries.clamp(min=1)).cpu(),
+            "tries": self.epoch_tries.cpu(),
+            "iters": self.iters().cpu(),
+            "step_scale": self.step_scale().cpu(),
+            "attempts": self.attempts().cpu(),
+            "hopeless": int(self.hopeless().sum()),
+        }
+        self.epoch_tries.zero_()
+        self.epoch_hits.zero_()
+        return summary
 
-def train_net(
+
+def generate_batch(
     model_train,
     model_gen,
-    criterion,
-    optimizer_train,
     inputs_orig,
     targets_orig,
     gen_idx,
     gen_targets,
+    normalize=None,
+    accept_table=None,
+    batch_index=None,
+    store=None,
+    seed_index=None,
+    budget=None,
 ):
+    """
+    Pick seeds for the generation targets of a batch and translate them.
+    Runs on the device of `inputs_orig`, so it can also run on a separate
+    generation device with copies of the models.
+    With a SeedIndex, seeds come from the whole training set instead of
+    the batch.
+    With a TranslationStore and the dataset indices of the seeds, seeds that
+    were translated to the same target before start from that translation
+    and only run ARGS.warm_iter refinement steps.
+    With an AttackBudget, each slot is attacked from several seeds as the
+    budget of its target class says, and keeps its first accepted attack.
+    Returns the generated samples and the stats of its generation() calls,
+    for add_gen_stats on the main thread.
+    """
     batch_size = inputs_orig.size(0)
-
-    inputs = inputs_orig.clone()
-    targets = targets_orig.clone()
-    gen_idx = gen_idx.to(device)
-    gen_targets = gen_targets.to(device)
-
-    ########################
-
-    bs = N_SAMPLES_PER_CLASS_T[targets_orig].repeat(gen_idx.size(0), 1)
-    gs = N_SAMPLES_PER_CLASS_T[gen_targets].view(-1, 1)
-    delta = F.relu(bs - gs)
-    p_accept = 1 - ARGS.beta**delta
-    mask_valid = (p_accept.sum(1) > 0).to(device)
+    gen_device = inputs_orig.device
+    if accept_table is None:
+        accept_table = ACCEPT_TABLE
+
+    gen_idx = gen_idx.to(gen_device)
+    gen_targets = gen_targets.to(gen_device)
+
+    if budget is not None:
+        accept_table = budget.accept_table().to(gen_device)
+        attempts = budget.attempts().to(gen_device)[gen_targets]
+        slot = torch.arange(gen_targets.size(0), device=gen_device)
+        slot = torch.repeat_interleave(slot, attempts)
+        gen_idx, gen_targets = gen_idx[slot], gen_targets[slot]
+
+    if seed_index is not None:
+        mask_valid, select_idx, p_accept = seed_index.sample(
+            gen_targets, None if budget is None else accept_table
+        )
+        seed_targets = seed_index.targets[select_idx]
+        seed_images = seed_index.get(select_idx)
+        seed_ids = select_idx
+    else:
+        mask_valid, select_idx, p_accept = sample_seeds(
+            targets_orig, gen_targets, accept_table
+        )
+        seed_targets = targets_orig[select_idx]
+        seed_images = inputs_orig[select_idx]
+        seed_ids = None
+        if batch_index is not None:
+            seed_ids = batch_index.to(gen_device)[select_idx]
 
     gen_idx = gen_idx[mask_valid]
     gen_targets = gen_targets[mask_valid]
-    p_accept = p_accept[mask_valid]
-
-    select_idx = torch.multinomial(p_accept, 1, replacement=True).view(-1)
-    p_accept = p_accept.gather(1, select_idx.view(-1, 1)).view(-1)
-
-    seed_targets = targets_orig[select_idx]
-    seed_images = inputs_orig[select_idx]
+    # The first attack of every slot; the others are extra attempts
+    first_try = torch.ones_like(gen_targets, dtype=torch.bool)
+    if budget is not None:
+        slot = slot[mask_valid]
+        first_try[1:] = slot[1:] != slot[:-1]
 
     if ARGS.ratio == 1 and ARGS.imb_type == "none":
         p_accept = torch.ones_like(p_accept)
-        gen_idx = torch.arange(batch_size).to(device)
+        gen_idx = torch.arange(batch_size).to(gen_device)
         # gen_targets = torch.randint(N_CLASSES, (batch_size,)).to(device).long()
         gen_targets = targets_orig  # why? because we want to generate the same class
         seed_targets = targets_orig
         seed_images = inputs_orig
-
-    gen_inputs, correct_mask = generation(
-        model_gen,
-        model_train,
-        seed_images,
-        seed_targets,
-        gen_targets,
-        p_accept,
-        ARGS.gamma,
+        select_idx = torch.arange(batch_size).to(gen_device)
+        first_try = torch.ones_like(gen_targets, dtype=torch.bool)
+
+    gen_stats = []
+
+    def _generate(images, mask, random_start, max_iter):
+        gen_inputs, correct, stats = generation(
+            model_gen,
+            model_train,
+            images[mask],
+            seed_targets[mask],
+            gen_targets[mask],
+            p_accept[mask],
+            ARGS.gamma,
+            ARGS.lam,
+            ARGS.step_size,
+            random_start,
+            max_iter,
+            ARGS.early_exit,
+            normalize,
+            budget,
+        )
+        # Savings are counted against one ARGS.attack_iter attack per slot,
+        # extra attempts apart
+        first_a = first_try[mask]
+        if stats["sample_steps"] is not None:
+            stats["extra"] = int(stats["sample_steps"][~first_a].sum())
+        first_steps = stats["steps"] - stats["extra"]
+        stats["saved"] = int(first_a.sum()) * ARGS.attack_iter - first_steps
+        gen_stats.append(stats)
+        return gen_inputs, correct
+
+    if store is None or seed_ids is None:
+        everything = torch.ones_like(gen_targets, dtype=torch.bool)
+        gen_inputs, correct_mask = _generate(
+            seed_images, everything, True, ARGS.attack_iter
+        )
+    else:
+        keys = store.keys(seed_ids, gen_targets)
+        hit, slots = store.lookup(keys)
+        start_images = seed_images.clone()
+        start_images[hit] = store.get(slots[hit])
+
+        gen_inputs = torch.empty_like(seed_images)
+        correct_mask = torch.zeros_like(gen_targets, dtype=torch.uint8)
+        for mask, random_start, max_iter in [
+            (~hit, True, ARGS.attack_iter),
+            (hit, False, ARGS.warm_iter),
+        ]:
+            if mask.any():
+                gen_inputs[mask], correct_mask[mask] = _generate(
+                    start_images, mask, random_start, max_iter
+                )
+        store.put(keys, gen_inputs)
+
+    generated = (gen_idx, gen_targets, seed_targets, gen_inputs, correct_mask)
+    if budget is not None and slot.size(0) > 0:
+        # One attack per slot: the first accepted one, else the first one
+        n = slot.size(0)
+        rejected = (correct_mask == 0).long()
+        position = torch.arange(n, device=gen_device)
+        order = torch.argsort(slot * 2 * n + rejected * n + position)
+        first = torch.ones(n, dtype=torch.bool, device=gen_device)
+        first[1:] = slot[order][1:] != slot[order][:-1]
+        generated = tuple(x[order[first]] for x in generated)
+
+    return generated, gen_stats
+
+
+def get_gen_store_dir():
+    """GenerationStore directory for the net_g checkpoint and the M2m setting."""
+    if ARGS.net_g is None:
+        raise ValueError("--export_gen and --offline_gen need --net_g")
+    key = "{}_{}_L{}_G{}_E{}_I{}_B{}".format(
+        file_hash(ARGS.net_g),
+        get_cache_key(DATASET, ARGS.ratio, N_SAMPLES, ARGS.imb_type, ARGS.imb_start),
         ARGS.lam,
+        ARGS.gamma,
         ARGS.step_size,
-        True,
         ARGS.attack_iter,
+        ARGS.beta,
     )
+    if ARGS.over and ARGS.effect_over:
+        # p_accept is computed from the effective numbers
+        key += "_EB{}".format(ARGS.eff_beta)
+    return os.path.join(ARGS.gen_store, key)
+
+
+def export_generation(net_g, data_loader, store_dir, epochs=1):
+    """
+    Run the M2m attack in bulk over the training set and save every
+    translation whose g-confidence reaches gamma as a GenerationStore.
+    `data_loader` should not augment: seeds are the training images as they
+    are, and --offline_gen trains on the stored translations as they are.
+    net_g is frozen, so it also plays model_r in the seed-class regularizer.
+    p_accept is stored rather than applied: the Bernoulli draw happens when
+    training with --offline_gen.
+    """
+    records = {name: [] for name in GenerationStore.FIELDS}
+    # Targets are drawn in proportion to the missing samples of each class
+    deficit = N_SAMPLES_PER_CLASS_T.max() - N_SAMPLES_PER_CLASS_T
+
+    for _ in range(epochs):
+        for inputs, targets, batch_index in tqdm(data_loader):
+            inputs, targets = inputs.to(device), targets.to(device)
+            gen_targets = torch.multinomial(deficit, inputs.size(0), replacement=True)
+
+            mask_valid, select_idx, p_accept = sample_seeds(
+                targets, gen_targets, ACCEPT_TABLE
+            )
+            gen_targets = gen_targets[mask_valid]
+            seed_targets = targets[select_idx]
+
+            gen_inputs, correct, _ = generation(
+                net_g,
+                net_g,
+                inputs[select_idx],
+                seed_targets,
+                gen_targets,
+                torch.ones_like(p_accept),
+                ARGS.gamma,
+                ARGS.lam,
+                ARGS.step_size,
+                True,
+                ARGS.attack_iter,
+                ARGS.early_exit,
+            )
+            net_g.eval()
+            with torch.no_grad():
+                outputs_g, _ = net_g(normalizer(gen_inputs))
+            conf_g = torch.softmax(outputs_g, 1).gather(1, gen_targets.view(-1, 1))
+
+            keep = correct.bool()
+            fields = {
+                "images": gen_inputs.mul(255).round_().byte(),
+                "targets": gen_targets,
+                "seed_index": batch_index.to(device)[select_idx],
+                "seed_targets": seed_targets,
+                "p_accept": p_accept,
+                "conf_g": conf_g.view(-1),
+            }
+            for name, x in fields.items():
+                records[name].append(x[keep].cpu())
 
-    ########################
-
-    # Only change the correctly generated samples
-    if ARGS.ratio == 1 and ARGS.imb_type == "none":
-        probabilities = torch.full((batch_size,), ARGS.gen_prob, device=device)
-
-        correct_mask = torch.bernoulli(probabilities).bool()
-    num_gen = sum_t(correct_mask)
-    num_others = batch_size - num_gen
+    records = {name: torch.cat(x).numpy() for name, x in records.items()}
+    GenerationStore.save(store_dir, records)
 
-    gen_c_idx = gen_idx[correct_mask]
-    others_mask = torch.ones(batch_size, dtype=torch.bool, device=device)
-    others_mask[gen_c_idx] = 0
-    others_idx = others_mask.nonzero().view(-1)
+    counts = np.bincount(records["targets"], minlength=N_CLASSES)
+    logger.log("Exported %d translations to %s" % (len(records["targets"]), store_dir))
+    logger.log("Translations per class: %s" % counts.tolist())
 
-    if num_gen > 0:
-        gen_inputs_c = gen_inputs[correct_mask]
-        gen_targets_c = gen_targets[correct_mask]
 
-        inputs[gen_c_idx] = gen_inputs_c
-        targets[gen_c_idx] = gen_targets_c
+def offline_generate_batch(store, gen_idx, gen_targets):
+    """
+    generate_batch counterpart for --offline_gen: every generation target
+    gets a stored translation of its class, accepted with the p_accept of
+    its seed.
+    """
+    valid, index = store.sample(gen_targets)
+    valid = valid.to(gen_idx.device)
+    gen_inputs, seed_targets, p_accept = store.get(index)
+    correct_mask = torch.bernoulli(p_accept).byte()
 
-    outputs, _ = model_train(normalizer(inputs))
-    loss = criterion(outputs, targets)
+    generated = (gen_idx[valid], gen_targets[valid], seed_targets, gen_inputs)
+    return tuple(x.to(device) for x in generated + (correct_mask,))
 
-    optimizer_train.zero_grad()
-    loss.mean().backward()
-    optimizer_train.step()
 
-    # For logging the training
+def train_net(
+    model_train,
+    model_gen,
+    criterion,
+    optimizer_train,
+    inputs_orig,
+    targets_orig,
+    gen_idx,
+    gen_targets,
+    generated=None,
+    batch_index=None,
+    metrics=None,
+):
+    batch_size = inputs_orig.size(0)
 
-    oth_loss_total = sum_t(loss[others_idx])
-    gen_loss_total = sum_t(loss[gen_c_idx])
+    inputs = inputs_orig.clone()
+    targets = targets_orig.clone()
 
-    _, predicted = torch.max(outputs[others_idx].data, 1)
-    num_correct_oth = sum_t(predicted.eq(targets[others_idx]))
+    ########################
 
-    num_correct_gen, p_g_orig, p_g_targ = 0, 0, 0
-    success = torch.zeros(N_CLASSES, 2)
+    # `generated` holds the output of generate_batch when it already ran
+    # ahead of time ( see GenerationPipeline )
+    if generated is None and GEN_STORE is not None:
+        generated = offline_generate_batch(GEN_STORE, gen_idx, gen_targets)
+    elif generated is None:
+        generated, gen_stats = generate_batch(
+            model_train,
+            model_gen,
+            inputs_orig,
+            targets_orig,
+            gen_idx,
+            gen_targets,
+            batch_index=batch_index,
+            store=TRANSLATION_STORE,
+            seed_index=SEED_INDEX,
+            budget=GEN_BUDGET,
+        )
+        add_gen_stats(gen_stats, GEN_BUDGET)
+    gen_idx, gen_targets, seed_targets, gen_inputs, correct_mask = generated
 
-    if num_gen > 0:
-        _, predicted_gen = torch.max(outputs[gen_c_idx].data, 1)
-        num_correct_gen = sum_t(predicted_gen.eq(targets[gen_c_idx]))
-        probs = torch.softmax(outputs[gen_c_idx], 1).data
+    ########################
 
-        p_g_orig = probs.gather(1, seed_targets[correct_mask].view(-1, 1))
-        p_g_orig = sum_t(p_g_orig)
+    # Only change the correctly generated samples
+    if ARGS.ratio == 1 and ARGS.imb_type == "none":
+        probabilities = torch.full((batch_size,), ARGS.gen_prob, device=device)
 
-        p_g_targ = probs.gather(1, gen_targets_c.view(-1, 1))
-        p_g_targ = sum_t(p_g_targ)
+        correct_mask = torch.bernoulli(probabilities).bool()
+    correct_mask = correct_mask.bool()
 
-    for i in range(N_CLASSES):
-        if num_gen > 0:
-            success[i, 0] = sum_t(gen_targets_c == i)
-        success[i, 1] = sum_t(gen_targets == i)
-    all_targets = targets.cpu().numpy()
-    num_samples_per_class = 50
-    # Ensure outputs is a list or sequence before concatenating
+    # Masks over the batch instead of index lists, so that nothing here
+    # waits for the device ( generation slots are distinct positions )
+    gen_mask = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    gen_mask[gen_idx] = correct_mask
+    others_mask = ~gen_mask
 
-    # Concatenate outputs into a single tensor
+    inputs[gen_idx] = torch.where(
+        correct_mask.view(-1, 1, 1, 1), gen_inputs, inputs[gen_idx]
+    )
+    targets[gen_idx] = torch.where(correct_mask, gen_targets, targets[gen_idx])
+    seed_of = torch.zeros_like(targets)
+    seed_of[gen_idx] = seed_targets
 
-    # Use the appropriate indexing for `all_outputs`
-    # Convert all_outputs to numpy for t-SNE
+    with autocast():
+        outputs, _ = model_train(normalizer(inputs))
+    outputs = outputs.float()
+    loss = criterion(outputs, targets)
 
-    return (
-        oth_loss_total,
-        gen_loss_total,
-        num_others,
-        num_correct_oth,
-        num_gen,
-        num_correct_gen,
-        p_g_orig,
-        p_g_targ,
-        success,
+    optimizer_train.zero_grad()
+    SCALER.scale(loss.mean()).backward()
+    SCALER.step(optimizer_train)
+    SCALER.update()
+
+    # For logging the training, as device tensors summed over the epoch
+
+    gen_f, others_f = gen_mask.float(), others_mask.float()
+    loss = loss.detach()
+    predicted_ok = outputs.detach().max(1)[1].eq(targets).float()
+    probs = torch.softmax(outputs.detach(), 1)
+    p_g_orig = probs.gather(1, seed_of.view(-1, 1)).view(-1)
+    p_g_targ = probs.gather(1, targets.view(-1, 1)).view(-1)
+
+    stats = torch.stack(
+        [
+            (loss * others_f).sum(),  # oth_loss_total
+            (loss * gen_f).sum(),  # gen_loss_total
+            others_f.sum(),  # num_others
+            (predicted_ok * others_f).sum(),  # num_correct_oth
+            gen_f.sum(),  # num_gen
+            (predicted_ok * gen_f).sum(),  # num_correct_gen
+            (p_g_orig * gen_f).sum(),  # p_g_orig
+            (p_g_targ * gen_f).sum(),  # p_g_targ
+        ]
     )
 
+    # Accepted / attempted generations per class
+    success = torch.stack(
+        [
+            torch.bincount(targets, weights=gen_f, minlength=N_CLASSES),
+            torch.bincount(gen_targets, minlength=N_CLASSES).float(),
+        ],
+        dim=1,
+    )
 
-def train_gen_epoch(net_t, net_g, criterion, optimizer, data_loader):
-    net_t.train()
-    net_g.eval()
+    # Accuracy metrics of the batch actually trained on, translated samples
+    # counting under their target class
+    if metrics is not None:
+        metrics.update(outputs, targets)
+
+    return stats, success
+
+
+class GenerationScheduler(object):
+    """
+    Quota-driven generation for --gen_chunk. Every epoch class t gets a quota
+    of generation requests equal to the number of its samples that the
+    Bernoulli draw of iter_gen_batches would replace in expectation, as the
+    slots of per-batch generation. The requests are spread over the batches
+    ( seeds come from the batch, or from a SeedIndex ) and generation() runs
+    on fixed-size chunks of them. Accepted translations then replace random
+    samples of their target class in the following batches; leftovers carry
+    over to the next epoch.
+    With `max_scale` > 1, quotas are instead divided by the acceptance rate
+    of the class in the last epoch ( by at most `max_scale` ), less its
+    leftover translations, so that accepted translations fill every slot
+    rather than the slots times the acceptance rate.
+    """
+
+    def __init__(self, chunk_size, seed_index=None, budget=None, max_scale=1.0):
+        self.chunk_size = chunk_size
+        self.seed_index = seed_index
+        self.budget = budget
+        self.max_scale = max_scale
+        # (seed images, seed targets, targets, p_accept) waiting for a chunk
+        self.pending = None
+        # (images, seed targets, targets) accepted and waiting for a batch
+        self.ready = None
+        self.quotas = torch.zeros(N_CLASSES, dtype=torch.long)
+        self.attempts = torch.zeros(N_CLASSES, dtype=torch.long)
+        self.accepted = torch.zeros(N_CLASSES, dtype=torch.long)
+
+    def start_epoch(self, data_loader):
+        n_batches = len(data_loader)
+        draws = get_class_draws(data_loader, N_CLASSES).float().to(device)
+        keep = N_SAMPLES_PER_CLASS_T / N_SAMPLES_PER_CLASS_T[0]
+        expected = draws * (1 - keep)
+
+        if self.max_scale > 1:
+            if self.ready is not None:
+                ready = torch.bincount(self.ready[2], minlength=N_CLASSES)
+                expected = (expected - ready).clamp(min=0)
+            attempts, accepted = self.attempts.to(device), self.accepted.to(device)
+            rate = torch.where(
+                attempts > 0,
+                accepted.float() / attempts.clamp(min=1),
+                torch.ones_like(expected),
+            )
+            expected = expected / rate.clamp(min=1 / self.max_scale)
+        quotas = torch.round(expected).long()
+
+        classes = torch.arange(N_CLASSES, device=device)
+        targets = torch.repeat_interleave(classes, quotas)
+        targets = targets[torch.randperm(targets.size(0), device=device)]
+        self.requests = torch.tensor_split(targets, n_batches)
+        self.quotas = quotas.cpu()
+        self.attempts.zero_()
+        self.accepted.zero_()
+        self.num_batches = 0
+
+    def _append(self, name, tensors):
+        queue = getattr(self, name)
+        if queue is not None:
+            tensors = [torch.cat([q, x]) for q, x in zip(queue, tensors)]
+        setattr(self, name, list(tensors))
+
+    def step(self, model_train, model_gen, inputs, targets):
+        """
+        Queue the requests of this batch, run every full chunk and return
+        the translations spliced into the batch, as generate_batch does.
+        """
+        if self.num_batches < len(self.requests):
+            gen_targets = self.requests[self.num_batches]
+            accept_table = ACCEPT_TABLE
+            if self.budget is not None:
+                accept_table = self.budget.accept_table()
+            if self.seed_index is not None:
+                mask_valid, select_idx, p_accept = self.seed_index.sample(
+                    gen_targets, accept_table
+                )
+                seed_images = self.seed_index.get(select_idx)
+                seed_targets = self.seed_index.targets[select_idx]
+            else:
+                mask_valid, select_idx, p_accept = sample_seeds(
+                    targets, gen_targets, accept_table
+                )
+                seed_images, seed_targets = inputs[select_idx], targets[select_idx]
+            request = (seed_images, seed_targets, gen_targets[mask_valid], p_accept)
+            self._append("pending", request)
+        self.num_batches += 1
+
+        while self.pending is not None and self.pending[0].size(0) >= self.chunk_size:
+            chunk = [x[: self.chunk_size] for x in self.pending]
+            self.pending = [x[self.chunk_size :] for x in self.pending]
+            seed_images, seed_targets, gen_targets, p_accept = chunk
+
+            gen_inputs, correct, stats = generation(
+                model_gen,
+                model_train,
+                seed_images,
+                seed_targets,
+                gen_targets,
+                p_accept,
+                ARGS.gamma,
+                ARGS.lam,
+                ARGS.step_size,
+                True,
+                ARGS.attack_iter,
+                ARGS.early_exit,
+                budget=self.budget,
+            )
+            add_gen_stats([stats], self.budget)
+            self.attempts += torch.bincount(gen_targets, minlength=N_CLASSES).cpu()
+            accepted = correct.bool()
+            self.accepted += torch.bincount(
+                gen_targets[accepted], minlength=N_CLASSES
+            ).cpu()
+            self._append(
+                "ready",
+                (gen_inputs[accepted], seed_targets[accepted], gen_targets[accepted]),
+            )
 
-    oth_loss, gen_loss = 0, 0
-    correct_oth = 0
-    correct_gen = 0
-    total_oth, total_gen = 1e-6, 1e-6
-    p_g_orig, p_g_targ = 0, 0
-    t_success = torch.zeros(N_CLASSES, 2)
+        return self._splice(inputs, targets)
+
+    def _splice(self, inputs, targets):
+        gen_idx = torch.zeros(0, dtype=torch.long, device=device)
+        if self.ready is None:
+            no_inputs = inputs.new_zeros((0,) + inputs.shape[1:])
+            return (gen_idx, gen_idx, gen_idx, no_inputs, gen_idx.byte())
+        gen_inputs, seed_targets, gen_targets = self.ready
+
+        # The r-th ready translation of class t ( oldest first ) replaces the
+        # r-th sample of class t in a random order of the batch, if there is
+        # one: like the Bernoulli draw of iter_gen_batches, any sample of the
+        # class may be replaced
+        counts = torch.bincount(targets, minlength=N_CLASSES)
+        noise = torch.rand(targets.size(0), device=targets.device)
+        order = torch.argsort(targets + noise)
+        starts = torch.cumsum(counts, 0) - counts
+
+        ready_counts = torch.bincount(gen_targets, minlength=N_CLASSES)
+        ready_starts = torch.cumsum(ready_counts, 0) - ready_counts
+        ready_order = torch.sort(gen_targets, stable=True)[1]
+        rank = torch.empty_like(ready_order)
+        rank[ready_order] = torch.arange(ready_order.size(0), device=device)
+        rank = rank - ready_starts[gen_targets]
+
+        use = rank < counts[gen_targets]
+        gen_idx = order[starts[gen_targets[use]] + rank[use]]
+        generated = (
+            gen_idx,
+            gen_targets[use],
+            seed_targets[use],
+            gen_inputs[use],
+            torch.ones_like(gen_idx, dtype=torch.uint8),
+        )
+        self.ready = [x[~use] for x in self.ready]
+        return generated
+
+
+def _unwrap(model):
+    return model.module if isinstance(model, nn.DataParallel) else model
+
+
+class GenerationPipeline(object):
+    """
+    Run generate_batch for the next batch in a background thread while the
+    current batch trains. On CUDA the work goes to its own stream, or to
+    `gen_device` when one is given; on CPU the thread uses spare cores.
+    Generation uses a copy of net_t that is refreshed every `staleness`
+    batches, so the seeds are attacked with weights at most that stale.
+    """
+
+    def __init__(
+        self,
+        net_t,
+        net_g,
+        staleness=1,
+        gen_device=None,
+        store=None,
+        seed_index=None,
+        budget=None,
+    ):
+        self.net_t = net_t
+        self.store = store
+        self.budget = budget
+        self.staleness = max(staleness, 1)
+        self.gen_device = device if gen_device is None else torch.device(gen_device)
+
+        self.model_r = copy.deepcopy(_unwrap(net_t)).to(self.gen_device)
+        if self.gen_device == device:
+            self.model_g = net_g
+        else:
+            self.model_g = copy.deepcopy(_unwrap(net_g)).to(self.gen_device)
+        self.normalize = copy.deepcopy(normalizer).to(self.gen_device)
+        self.accept_table = ACCEPT_TABLE.to(self.gen_device)
+        self.seed_index = None
+        if seed_index is not None:
+            self.seed_index = seed_index.to(self.gen_device)
+
+        self.stream = None
+        if self.gen_device.type == "cuda":
+            self.stream = torch.cuda.Stream(self.gen_device)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.num_submitted = 0
+        self.snapshot = None
+        self.loaded = None
+
+    def submit(self, inputs, targets, gen_index, gen_targets, batch_index=None):
+        if self.num_submitted % self.staleness == 0:
+            state = _unwrap(self.net_t).state_dict()
+            self.snapshot = {k: v.detach().clone() for k, v in state.items()}
+        self.num_submitted += 1
+
+        ready = None
+        if self.stream is not None:
+            # Inputs and the snapshot are produced on the current stream
+            ready = torch.cuda.Event()
+            ready.record()
+        return self.executor.submit(
+            self._generate,
+            inputs,
+            targets,
+            gen_index,
+            gen_targets,
+            batch_index,
+            self.snapshot,
+            ready,
+        )
 
-    all_targets = []
-    all_predicted = []
+    def _generate(self, *args):
+        ready = args[-1]
+        if self.stream is None:
+            return self._run(*args[:-1])
+
+        with torch.cuda.device(self.gen_device), torch.cuda.stream(self.stream):
+            self.stream.wait_event(ready)
+            out = self._run(*args[:-1])
+        self.stream.synchronize()
+        return out
+
+    def _run(self, inputs, targets, gen_index, gen_targets, batch_index, snapshot):
+        if snapshot is not self.loaded:
+            self.model_r.load_state_dict(snapshot)
+            self.loaded = snapshot
+
+        return generate_batch(
+            self.model_r,
+            self.model_g,
+            inputs.to(self.gen_device),
+            targets.to(self.gen_device),
+            gen_index,
+            gen_targets,
+            self.normalize,
+            self.accept_table,
+            batch_index,
+            self.store,
+            self.seed_index,
+            self.budget,
+        )
 
-    for inputs, targets in tqdm(data_loader):
+    def result(self, future):
+        generated, gen_stats = future.result()
+        add_gen_stats(gen_stats, self.budget)
+        out = tuple(x.to(device) for x in generated)
+        if self.stream is not None and self.gen_device == device:
+            # Tensors allocated on the generation stream are now used here
+            for x in out:
+                x.record_stream(torch.cuda.current_stream())
+        return out
+
+
+def iter_gen_batches(data_loader, pipeline=None):
+    """
+    Yield (inputs, targets, gen_index, gen_targets, batch_index, generated)
+    per batch; batch_index holds the dataset indices when the loader returns
+    them. Without a pipeline `generated` is None and train_net generates in
+    place; with one, generation of batch k+1 is submitted before batch k is
+    yielded.
+    """
+    pending = None
+    for batch in data_loader:
+        inputs, targets = batch[0], batch[1]
+        batch_index = batch[2] if len(batch) > 2 else None
         batch_size = inputs.size(0)
         inputs, targets = inputs.to(device), targets.to(device)
 
@@ -432,31 +1180,74 @@ def train_gen_epoch(net_t, net_g, criterion, optimizer, data_loader):
             gen_index = torch.arange(batch_size).view(-1)
             gen_targets = torch.randint(N_CLASSES, (batch_size,)).to(device).long()
 
-        (
-            t_loss,
-            g_loss,
-            num_others,
-            num_correct,
-            num_gen,
-            num_gen_correct,
-            p_g_orig_batch,
-            p_g_targ_batch,
-            success,
-        ) = train_net(
-            net_t, net_g, criterion, optimizer, inputs, targets, gen_index, gen_targets
+        batch = (inputs, targets, gen_index, gen_targets, batch_index)
+        if pipeline is None:
+            yield batch + (None,)
+            continue
+
+        future = pipeline.submit(*batch)
+        if pending is not None:
+            yield pending[0] + (pipeline.result(pending[1]),)
+        pending = (batch, future)
+
+    if pending is not None:
+        yield pending[0] + (pipeline.result(pending[1]),)
+
+
+def train_gen_epoch(net_t, net_g, criterion, optimizer, data_loader):
+    net_t.train()
+    net_g.eval()
+
+    # Per-step statistics of train_net, summed on the device
+    epoch_stats = torch.zeros(8, dtype=torch.double, device=device)
+    t_success = torch.zeros(N_CLASSES, 2, device=device)
+    metrics = StreamingMetrics(N_CLASSES, CLASS_GROUPS)
+    GEN_STATS.update(steps=0, extra=0, saved=0)
+
+    pipeline = GEN_PIPELINE
+    batches = iter_gen_batches(data_loader, pipeline)
+    if GEN_SCHEDULER is not None:
+        GEN_SCHEDULER.start_epoch(data_loader)
+
+    for inputs, targets, gen_index, gen_targets, batch_index, generated in tqdm(
+        batches, total=len(data_loader)
+    ):
+        if GEN_SCHEDULER is not None:
+            generated = GEN_SCHEDULER.step(net_t, net_g, inputs, targets)
+        stats, success = train_net(
+            net_t,
+            net_g,
+            criterion,
+            optimizer,
+            inputs,
+            targets,
+            gen_index,
+            gen_targets,
+            generated,
+            batch_index,
+            metrics,
         )
 
-        oth_loss += t_loss
-        gen_loss += g_loss
-        total_oth += num_others
-        correct_oth += num_correct
-        total_gen += num_gen
-        correct_gen += num_gen_correct
-        p_g_orig += p_g_orig_batch
-        p_g_targ += p_g_targ_batch
+        epoch_stats += stats.double()
         t_success += success
-        all_targets.extend(targets.cpu().numpy())
-        all_predicted.extend(targets.cpu().numpy())
+
+    (
+        oth_loss,
+        gen_loss,
+        total_oth,
+        correct_oth,
+        total_gen,
+        correct_gen,
+        p_g_orig,
+        p_g_targ,
+    ) = epoch_stats.tolist()
+    total_oth, total_gen = total_oth + 1e-6, total_gen + 1e-6
+    t_success = t_success.cpu()
+    train_results = metrics.compute()
+
+    if GEN_SCHEDULER is not None:
+        # Attempts happen per chunk, not per spliced sample
+        t_success[:, 1] = GEN_SCHEDULER.attempts.float()
 
     res = {
         "train_loss": oth_loss / total_oth,
@@ -466,8 +1257,8 @@ def train_gen_epoch(net_t, net_g, criterion, optimizer, data_loader):
         "p_g_orig": p_g_orig / total_gen,
         "p_g_targ": p_g_targ / total_gen,
         "t_success": t_success,
-        "train_bal_acc": balanced_accuracy_score(all_targets, all_predicted),
-        "train_gm": geometric_mean_score(all_targets, all_predicted),
+        "train_bal_acc": train_results["bal_acc"],
+        "train_gm": train_results["train_gm"],
     }
 
     msg = (
@@ -486,11 +1277,43 @@ def train_gen_epoch(net_t, net_g, criterion, optimizer, data_loader):
             res["p_g_targ"],
         )
     )
+    if ARGS.early_exit or GEN_BUDGET is not None:
+        # One ARGS.attack_iter attack per slot
+        num_steps = GEN_STATS["steps"] - GEN_STATS["extra"] + GEN_STATS["saved"]
+        msg += " | Attack steps: %d (extra attempts %d, saved %d, %.1f%%)" % (
+            GEN_STATS["steps"],
+            GEN_STATS["extra"],
+            GEN_STATS["saved"],
+            100.0 * GEN_STATS["saved"] / max(num_steps, 1),
+        )
+    if GEN_SCHEDULER is not None:
+        msg += " | Quota: %d | Attempted: %d | Pending: %d" % (
+            GEN_SCHEDULER.quotas.sum(),
+            GEN_SCHEDULER.attempts.sum(),
+            0 if GEN_SCHEDULER.pending is None else GEN_SCHEDULER.pending[0].size(0),
+        )
+    res["attack_steps"] = GEN_STATS["steps"]
+    res["attack_steps_extra"] = GEN_STATS["extra"]
+    res["attack_steps_saved"] = GEN_STATS["saved"]
+
     if logger:
         logger.log(msg)
     else:
         print(msg)
 
+    if GEN_BUDGET is not None:
+        budget = GEN_BUDGET.epoch_summary()
+        res["class_accept"] = budget["accept"]
+        for name, values, fmt in [
+            ("Acceptance per class (%)", 100.0 * budget["accept"], "%.1f"),
+            ("Attacks per class", budget["tries"], "%d"),
+            ("Attack iters per class", budget["iters"], "%d"),
+            ("Step scale per class", budget["step_scale"], "%.2f"),
+            ("Attempts per class", budget["attempts"], "%d"),
+        ]:
+            logger.log("%s: %s" % (name, " ".join(fmt % v for v in values.tolist())))
+        logger.log("Hopeless (target, seed) pairs: %d" % budget["hopeless"])
+
     return res
 
 
@@ -529,9 +1352,31 @@ if __name__ == "__main__":
             if ARGS.net_g is not None:
                 ckpt_g = ARGS.net_g
                 print(ckpt_g)
-                ckpt_g = torch.load(ckpt_g)
+                ckpt_g = load_checkpoint(ckpt_g)
                 net_seed.load_state_dict(ckpt_g["net"])
 
+    if ARGS.export_gen or ARGS.offline_gen:
+        if ARGS.imb_type == "none":
+            raise ValueError("Stored translations need an imbalanced training set")
+        GEN_STORE_DIR = get_gen_store_dir()
+
+    if ARGS.export_gen:
+        net_seed.load_state_dict(load_checkpoint(ARGS.net_g)["net"])
+        # Seeds come from the un-augmented training set
+        export_loader = get_imbalanced(
+            DATASET,
+            N_SAMPLES_PER_CLASS_BASE,
+            BATCH_SIZE,
+            transform_test,
+            transform_test,
+            cache_key=CACHE_KEY,
+            device=TRAIN_DATA_DEVICE,
+            augment=False,
+            return_index=True,
+        )[0]
+        export_generation(net_seed, export_loader, GEN_STORE_DIR, ARGS.export_epochs)
+        raise SystemExit
+
     if N_GPUS > 1:
         logger.log("Multi-GPU mode: using %d GPUs for training." % N_GPUS)
         net = nn.DataParallel(net)
@@ -542,6 +1387,72 @@ if __name__ == "__main__":
     if ARGS.warm < START_EPOCH and ARGS.over:
         raise ValueError("warm < START_EPOCH")
 
+    if ARGS.cached_eval:
+        EVAL_SET = EvalSet(val_loader, test_loader)
+
+    TRANSLATION_STORE = None
+    if ARGS.gen and ARGS.warm_start:
+        if ARGS.async_gen and ARGS.gen_device is not None:
+            store_device = torch.device(ARGS.gen_device)
+        else:
+            store_device = device
+        # Dataset indices never exceed the size of the training split, which
+        # may hold more samples than requested ( see load_cifar_lt )
+        split = load_cifar_lt(DATASET, N_SAMPLES_PER_CLASS_BASE, CACHE_KEY)
+        TRANSLATION_STORE = TranslationStore(
+            len(split["train_targets"]),
+            N_CLASSES,
+            ARGS.warm_store_size,
+            (3, 32, 32),
+            ARGS.warm_store_dtype,
+            store_device,
+        )
+
+    GEN_STORE = None
+    if ARGS.gen and ARGS.offline_gen:
+        GEN_STORE = GenerationStore(GEN_STORE_DIR, N_CLASSES)
+        logger.log("==> Offline generation from %s" % GEN_STORE_DIR)
+
+    SEED_INDEX = None
+    if ARGS.gen and ARGS.seed_index and GEN_STORE is None:
+        if ARGS.imb_type == "none":
+            raise ValueError("--seed_index needs an imbalanced training set")
+        logger.log("==> Ranking seeds with net_g")
+        SEED_INDEX = SeedIndex(net_seed, train_loader, ACCEPT_TABLE, ARGS.seed_topk)
+
+    GEN_BUDGET = None
+    if ARGS.gen and ARGS.adaptive_budget and GEN_STORE is None:
+        if ARGS.imb_type == "none":
+            raise ValueError("--adaptive_budget needs an imbalanced training set")
+        GEN_BUDGET = AttackBudget(
+            ACCEPT_TABLE,
+            ARGS.attack_iter,
+            min_tries=ARGS.budget_min_tries,
+            max_attempts=ARGS.budget_max_attempts,
+        )
+
+    GEN_SCHEDULER = None
+    if ARGS.gen and ARGS.gen_chunk > 0:
+        if ARGS.async_gen or ARGS.offline_gen or ARGS.imb_type == "none":
+            raise ValueError(
+                "--gen_chunk needs online, synchronous generation on imbalanced data"
+            )
+        GEN_SCHEDULER = GenerationScheduler(
+            ARGS.gen_chunk, SEED_INDEX, GEN_BUDGET, ARGS.gen_quota_scale
+        )
+
+    GEN_PIPELINE = None
+    if ARGS.gen and ARGS.async_gen and GEN_STORE is None:
+        GEN_PIPELINE = GenerationPipeline(
+            net,
+            net_seed,
+            ARGS.gen_staleness,
+            ARGS.gen_device,
+            TRANSLATION_STORE,
+            SEED_INDEX,
+            GEN_BUDGET,
+        )
+
     SUCCESS = torch.zeros(EPOCH, N_CLASSES, 2)
     test_stats = {}
     for epoch in range(START_EPOCH, EPOCH):
@@ -558,6 +1469,11 @@ if __name__ == "__main__":
                     BATCH_SIZE,
                     transform_train,
                     transform_test,
+                    cache_key=CACHE_KEY,
+                    lazy=ARGS.lazy_smote,
+                    device=TRAIN_DATA_DEVICE,
+                    augment=ARGS.augment,
+                    legacy_distance=ARGS.smote_legacy_distance,
                 )
                 smote_loader_inf = inf_data_gen(smote_loader)
             else:
@@ -568,44 +1484,14 @@ if __name__ == "__main__":
                     BATCH_SIZE,
                     transform_train,
                     transform_test,
+                    cache_key=CACHE_KEY,
+                    device=TRAIN_DATA_DEVICE,
+                    augment=ARGS.augment,
+                    class_aware=ARGS.class_aware,
+                    return_index=ARGS.warm_start,
                 )
 
-        ## For Cost-Sensitive Learning ##
-
-        if ARGS.cost and epoch >= ARGS.warm:
-            beta = ARGS.eff_beta
-            if beta < 1:
-                effective_num = 1.0 - np.power(beta, N_SAMPLES_PER_CLASS)
-                per_cls_weights = (1.0 - beta) / np.array(effective_num)
-            else:
-                per_cls_weights = 1 / np.array(N_SAMPLES_PER_CLASS)
-            per_cls_weights = (
-                per_cls_weights / np.sum(per_cls_weights) * len(N_SAMPLES_PER_CLASS)
-            )
-            per_cls_weights = torch.FloatTensor(per_cls_weights).to(device)
-        else:
-            per_cls_weights = torch.ones(N_CLASSES).to(device)
-
-        ## Choos a loss function ##
-
-        if ARGS.loss_type == "CE":
-            criterion = nn.CrossEntropyLoss(
-                weight=per_cls_weights, reduction="none"
-            ).to(device)
-        elif ARGS.loss_type == "Focal":
-            criterion = FocalLoss(
-                weight=per_cls_weights, gamma=ARGS.focal_gamma, reduction="none"
-            ).to(device)
-        elif ARGS.loss_type == "LDAM":
-            criterion = LDAMLoss(
-                cls_num_list=N_SAMPLES_PER_CLASS,
-                max_m=0.5,
-                s=30,
-                weight=per_cls_weights,
-                reduction="none",
-            ).to(device)
-        else:
-            raise ValueError("Wrong Loss Type")
+        criterion = get_criterion(epoch)
 
         ## Training ( ARGS.warm is used for deferred re-balancing ) ##
 
@@ -645,7 +1531,10 @@ if __name__ == "__main__":
 
         ## Evaluation ##
 
-        val_eval = evaluate(net, val_loader, logger=logger)
+        if ARGS.cached_eval:
+            val_eval, test_eval = evaluate_cached(net, EVAL_SET, logger=logger)
+        else:
+            val_eval = evaluate(net, val_loader, logger=logger)
         val_eval_copy_for_log = val_eval.copy()
         # add key name prefix val_
         val_eval_copy_for_log = {
@@ -661,7 +1550,11 @@ if __name__ == "__main__":
         if val_acc >= BEST_VAL:
             BEST_VAL = val_acc
 
-            test_stats = evaluate(net, test_loader, logger=logger)
+            if ARGS.cached_eval:
+                test_stats = test_eval
+                log_eval_results(test_stats, logger)
+            else:
+                test_stats = evaluate(net, test_loader, logger=logger)
             test_stats_copy_for_log = test_stats.copy()
             # add key name prefix test_
             test_stats_copy_for_log = {
@@ -687,84 +1580,9 @@ if __name__ == "__main__":
             )
             np.save(LOGDIR + "/classwise_acc.npy", TEST_ACC_CLASS.cpu())
 
-        def _convert_scala(x):
-            if hasattr(x, "item"):
-                x = x.item()
-            return x
-
-        log_tr = [
-            "train_loss",
-            "gen_loss",
-            "train_acc",
-            "gen_acc",
-            "p_g_orig",
-            "p_g_targ",
-            "train_bal_acc",
-            "train_gm",
-        ]
-        log_te = [
-            "loss",
-            "major_acc",
-            "neutral_acc",
-            "minor_acc",
-            "acc",
-            "f1_score",
-            "test_gm",
-            "test_bal_acc",
-        ]
-
-        log_vector = (
-            [epoch]
-            + [train_stats.get(k, 0) for k in log_tr]
-            + [test_stats.get(k, 0) for k in log_te]
-        )
-        log_vector = list(map(_convert_scala, log_vector))
-
-        with open(LOG_CSV, "a") as f:
-            logwriter = csv.writer(f, delimiter=",")
-            logwriter.writerow(log_vector)
+        append_log_csv(LOG_CSV, epoch, train_stats, test_stats)
         # log using wandb
-    df = pd.read_csv(LOG_CSV)
-    df_table = wandb.Table(dataframe=df)
-    csv_folder = os.path.join("/home/ubuntu/M2m/", "csv")
-    os.makedirs(csv_folder, exist_ok=True)
-    test_last_idx = df["test bal acc"].idxmax()
-    test_last_result = df.loc[test_last_idx]
-    test_last_result["name"] = ARGS.name
-    test_last_result["model"] = ARGS.model
-    file_name = f"{ARGS.dataset}_{ARGS.ratio}_{ARGS.n_samples}.csv"
-    # specify the path to the csv file
-    csv_file_path = os.path.join(csv_folder, file_name)
-    new_df = pd.DataFrame([test_last_result]).round(2)
-    # check if the file exists
-    if os.path.isfile(csv_file_path):
-        # load the existing csv file into a DataFrame
-        existing_df = pd.read_csv(csv_file_path)
-
-        # check if ARGS.name is already in the DataFrame
-        if ARGS.name not in existing_df["name"].values:
-            # if not, append test_last_result to the DataFrame
-            existing_df = pd.concat([existing_df, new_df], axis=0, ignore_index=True)
-
-            # save the DataFrame to the csv file
-            existing_df.round(2).to_csv(csv_file_path, index=False)
-        elif ARGS.name in existing_df["name"].values:
-            # if ARGS.name is already in the DataFrame, update the row with test_last_result if the test accuracy of the new result is higher
-            existing_idx = existing_df[existing_df["name"] == ARGS.name].index[0]
-            if (
-                test_last_result["test bal acc"]
-                > existing_df.loc[existing_idx]["test bal acc"]
-            ) and (
-                test_last_result["test gm"] > existing_df.loc[existing_idx]["test gm"]
-            ):
-                existing_df.loc[existing_idx] = test_last_result.round(2)
-
-                # save the DataFrame to the csv file
-                existing_df.round(2).to_csv(csv_file_path, index=False)
-    else:
-        # if the file doesn't exist, create a new DataFrame from test_last_result
-
-        # save the new DataFrame to the csv file
-        new_df.to_csv(csv_file_path, index=False)
-    wandb.log({"table": df_table})
+    if EMBED_POOL is not None:
+        EMBED_POOL.shutdown(wait=True)
+    report_run(LOG_CSV)
     wandb.finish()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3 -u
+"""
+Train --model_batch models of one configuration in lockstep on one device,
+fused into a BatchedCifarResNet. Model k has its own seed ( SEED + k ),
+initialization, training loader ( seeded sampling and augmentation ), loss
+weights ( --batch_eff_beta ), optimizer state, log dir, CSV log, checkpoints
+and csv/ summary row, as with `train.py --seed SEED + k`.
+
+    python train_batch.py --no_over -c --eff_beta 0.999 --ratio 100 \
+        --decay 2e-4 --model resnet32 --dataset cifar10 --lr 0.1 \
+        --batch-size 128 --name 'ERM-CBLoss' --warm 160 --epoch 200 \
+        --seed 0 --model_batch 4
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+
+def parse_batch_args():
+    """
+    Options of train_batch.py only; the other arguments are left in sys.argv
+    for config.py, which parses them when imported.
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "--model_batch",
+        default=4,
+        type=int,
+        help="Models trained in lockstep ( seeds SEED + k )",
+    )
+    parser.add_argument(
+        "--batch_eff_beta",
+        default=None,
+        type=float,
+        nargs="+",
+        help="Per-model --eff_beta, one per model",
+    )
+    args, sys.argv[1:] = parser.parse_known_args()
+    return args
+
+
+BATCH_ARGS = parse_batch_args()
+
+from config import *
+from metrics import StreamingMetrics
+from tqdm import tqdm
+from utils import Logger
+
+if ARGS.gen or ARGS.smote:
+    raise ValueError("train_batch.py supports neither -gen nor --smote")
+if ARGS.net_t is not None or ARGS.net_both is not None:
+    raise ValueError("train_batch.py does not resume from checkpoints")
+
+N_MODELS = BATCH_ARGS.model_batch
+SEEDS = [SEED + k for k in range(N_MODELS)]
+EFF_BETAS = BATCH_ARGS.batch_eff_beta or [ARGS.eff_beta] * N_MODELS
+if len(EFF_BETAS) != N_MODELS:
+    raise ValueError("--batch_eff_beta needs one value per model")
+
+LOGGERS = [Logger("Imbalance_" + get_logfile_base(seed)) for seed in SEEDS]
+LOG_CSVS = [
+    os.path.join(logger.logdir, f"log_{seed}.csv")
+    for logger, seed in zip(LOGGERS, SEEDS)
+]
+for log_csv in LOG_CSVS:
+    init_log_csv(log_csv)
+
+
+def log_all(msg):
+    for logger in LOGGERS:
+        logger.log(msg)
+
+
+def get_train_loaders(oversampled=False):
+    """
+    One training loader per model over the same split, whose sampling and
+    augmentation are seeded with the seed of the model.
+    """
+    if oversampled:
+        return [
+            get_oversampled(
+                DATASET,
+                N_SAMPLES_PER_CLASS,
+                BATCH_SIZE,
+                transform_train,
+                transform_test,
+                cache_key=CACHE_KEY,
+                device=TRAIN_DATA_DEVICE,
+                augment=ARGS.augment,
+                class_aware=ARGS.class_aware,
+                seed=seed,
+            )[0]
+            for seed in SEEDS
+        ]
+    return [
+        get_imbalanced(
+            DATASET,
+            N_SAMPLES_PER_CLASS_BASE,
+            BATCH_SIZE,
+            transform_train,
+            transform_test,
+            cache_key=CACHE_KEY,
+            device=TRAIN_DATA_DEVICE,
+            augment=ARGS.augment,
+            seed=seed,
+        )[0]
+        for seed in SEEDS
+    ]
+
+
+def save_checkpoint(acc, net, optimizer, k, epoch, index=False):
+    """Save model k alone, in the format of train.py's checkpoints."""
+    state = {
+        "net": net.model_state_dict(k),
+        "optimizer": net.model_optimizer_state(optimizer, k),
+        "acc": acc,
+        "epoch": epoch,
+        "rng_state": torch.get_rng_state(),
+    }
+
+    if index:
+        ckpt_name = "ckpt_epoch" + str(epoch) + "_" + str(SEEDS[k]) + ".t7"
+    else:
+        ckpt_name = "ckpt_" + str(SEEDS[k]) + ".t7"
+    torch.save(state, os.path.join(LOGGERS[k].logdir, ckpt_name))
+    # Reference checkpoints have no seed in their name: keep those of model 0,
+    # the run of `train.py --seed SEED`
+    if k == 0:
+        save_reference_checkpoint(state, epoch)
+
+
+def train_epoch(net, criteria, optimizer, loaders):
+    net.train()
+
+    # As in train.py, balanced accuracy and G-mean cover the first 50 samples
+    # of each class in loader order
+    metrics = [
+        StreamingMetrics(N_CLASSES, CLASS_GROUPS, per_class=50) for _ in range(N_MODELS)
+    ]
+
+    for batches in tqdm(zip(*loaders), total=len(loaders[0])):
+        inputs = torch.stack([normalizer(batch[0].to(device)) for batch in batches], 1)
+        targets = [batch[1].to(device) for batch in batches]
+
+        with autocast():
+            outputs, _ = net(inputs)
+        outputs = outputs.float()
+        losses = [
+            criterion(outputs[:, k], targets[k]).mean()
+            for k, criterion in enumerate(criteria)
+        ]
+        for k in range(N_MODELS):
+            metrics[k].update(outputs[:, k], targets[k], losses[k])
+
+        # The models share no parameter, so each one only gets the gradient of
+        # its own loss ( with fp16, loss scaling is shared )
+        optimizer.zero_grad()
+        SCALER.scale(sum(losses)).backward()
+        SCALER.step(optimizer)
+        SCALER.update()
+
+    train_stats = []
+    for logger, results in zip(LOGGERS, [m.compute() for m in metrics]):
+        logger.log(
+            "Loss: %.3f| Acc: %.3f%% (%d/%d) | GMean: %.3f | BalAcc: %.3f"
+            % (
+                results["loss"],
+                results["acc"],
+                results["correct"],
+                results["total"],
+                results["train_gm"],
+                results["bal_acc"],
+            )
+        )
+        train_stats.append(
+            {
+                "train_loss": results["loss"],
+                "train_acc": results["acc"],
+                "train_bal_acc": results["bal_acc"],
+                "train_gm": results["train_gm"],
+            }
+        )
+    return train_stats
+
+
+def evaluate_batch(net, dataloader, loggers):
+    """evaluate() of every model on the same split; `loggers` may be False."""
+    is_training = net.training
+    net.eval()
+    criterion = nn.CrossEntropyLoss()
+    metrics = [StreamingMetrics(N_CLASSES, CLASS_GROUPS) for _ in range(N_MODELS)]
+
+    with torch.no_grad():
+        for inputs, targets in dataloader:
+            inputs, targets = inputs.to(device), targets.to(device)
+            inputs = normalizer(inputs).unsqueeze(1).expand(-1, N_MODELS, -1, -1, -1)
+
+            with autocast():
+                outputs, _ = net(inputs)
+            outputs = outputs.float()
+            for k in range(N_MODELS):
+                loss = criterion(outputs[:, k], targets)
+                metrics[k].update(outputs[:, k, :N_CLASSES], targets, loss)
+
+    net.train(is_training)
+    if loggers is False:
+        loggers = [False] * N_MODELS
+    return [get_eval_results(m, logger) for m, logger in zip(metrics, loggers)]
+
+
+if __name__ == "__main__":
+    log_all("==> Building %d models: %s" % (N_MODELS, MODEL))
+    nets = []
+    for seed in SEEDS:
+        torch.manual_seed(seed)
+        nets.append(models.__dict__[MODEL](N_CLASSES))
+    if not isinstance(nets[0], models.CifarResNet):
+        raise ValueError("train_batch.py only batches CifarResNet models")
+    net = models.BatchedCifarResNet(nets).to(device)
+    del nets
+
+    # SGD is element-wise, so one optimizer over the fused parameters steps
+    # every model exactly as its own optimizer would
+    optimizer = optim.SGD(
+        net.parameters(), lr=ARGS.lr, momentum=0.9, weight_decay=ARGS.decay
+    )
+
+    loaders = get_train_loaders()
+    best_val = [0] * N_MODELS
+    test_stats = [{} for _ in range(N_MODELS)]
+    for epoch in range(START_EPOCH, EPOCH):
+        for logger in LOGGERS:
+            logger.log(" * Epoch %d: %s" % (epoch, logger.logdir))
+        adjust_learning_rate(optimizer, LR, epoch)
+
+        if epoch == ARGS.warm and ARGS.over:
+            log_all("=============== Applying over sampling ===============")
+            loaders = get_train_loaders(oversampled=True)
+
+        criteria = [get_criterion(epoch, eff_beta) for eff_beta in EFF_BETAS]
+        train_stats = train_epoch(net, criteria, optimizer, loaders)
+        if epoch == 159:
+            for k in range(N_MODELS):
+                save_checkpoint(
+                    train_stats[k]["train_acc"], net, optimizer, k, epoch, True
+                )
+
+        ## Evaluation ##
+
+        val_evals = evaluate_batch(net, val_loader, LOGGERS)
+        improved = [
+            k for k in range(N_MODELS) if val_evals[k]["test_bal_acc"] >= best_val[k]
+        ]
+        if improved:
+            test_evals = evaluate_batch(net, test_loader, False)
+        for k in improved:
+            best_val[k] = val_evals[k]["test_bal_acc"]
+            test_stats[k] = test_evals[k]
+            log_eval_results(test_stats[k], LOGGERS[k])
+
+            save_checkpoint(test_stats[k]["test_bal_acc"], net, optimizer, k, epoch)
+            test_acc_class = test_stats[k]["class_acc"]
+            LOGGERS[k].log(
+                "========== Class-wise test performance ( avg : {} ) ==========".format(
+                    test_acc_class.mean()
+                )
+            )
+            np.save(LOGGERS[k].logdir + "/classwise_acc.npy", test_acc_class.cpu())
+
+        for k in range(N_MODELS):
+            append_log_csv(LOG_CSVS[k], epoch, train_stats[k], test_stats[k])
+
+    for log_csv, seed in zip(LOG_CSVS, SEEDS):
+        report_run(log_csv, "table_%d" % seed)
+    wandb.finish()
@@ -4,6 +4,7 @@
     - progress_bar: progress bar mimic xlua.progress.
 """
 
+import hashlib
 import importlib
 import math
 import os
@@ -39,8 +40,8 @@ class InputNormalize(nn.Module):
 
     def __init__(self, new_mean, new_std):
         super(InputNormalize, self).__init__()
-        new_std = new_std[..., None, None].cuda()
-        new_mean = new_mean[..., None, None].cuda()
+        new_std = new_std[..., None, None]
+        new_mean = new_mean[..., None, None]
 
         # To prevent the updates the mean, std
         self.register_buffer("new_mean", new_mean)
@@ -151,17 +152,16 @@ class LDAMLoss(nn.Module):
         super(LDAMLoss, self).__init__()
         m_list = 1.0 / np.sqrt(np.sqrt(cls_num_list))
         m_list = m_list * (max_m / np.max(m_list))
-        m_list = torch.cuda.FloatTensor(m_list)
-        self.m_list = m_list
+        self.register_buffer("m_list", torch.tensor(m_list, dtype=torch.float))
         self.scale = s
         self.weight = weight
         self.reduction = reduction
 
     def forward(self, x, target):
-        index = torch.zeros_like(x, dtype=torch.uint8)
-        index.scatter_(1, target.data.view(-1, 1), 1)
+        index = torch.zeros_like(x, dtype=torch.bool)
+        index.scatter_(1, target.data.view(-1, 1), True)
 
-        index_float = index.type(torch.cuda.FloatTensor)
+        index_float = index.to(self.m_list.dtype)
         batch_m = torch.matmul(self.m_list[None, :], index_float.transpose(0, 1))
         batch_m = batch_m.view((-1, 1))
         x_m = x - batch_m
@@ -196,6 +196,43 @@ def make_step(grad, attack, step_size):
     return step
 
 
+def dual_forward(model_g, model_r, normalize, x, stream=None):
+    """
+    Forward `x` through both networks of the M2m attack with a single
+    normalization. Each network gets its own leaf copy of the normalized
+    input, so the two backward passes are independent. With a CUDA
+    `stream`, model_r runs on it concurrently with model_g.
+    Returns (outputs_g, outputs_r, x_g, x_r); see dual_input_grad.
+    """
+    with torch.no_grad():
+        x_norm = normalize(x)
+    x_g = x_norm.requires_grad_(True)
+    x_r = x_norm.detach().requires_grad_(True)
+
+    if stream is None:
+        outputs_g, _ = model_g(x_g)
+        outputs_r, _ = model_r(x_r)
+    else:
+        current = torch.cuda.current_stream(x.device)
+        stream.wait_stream(current)
+        outputs_g, _ = model_g(x_g)
+        with torch.cuda.stream(stream):
+            outputs_r, _ = model_r(x_r)
+        current.wait_stream(stream)
+    return outputs_g, outputs_r, x_g, x_r
+
+
+def dual_input_grad(loss, x_g, x_r, normalize):
+    """
+    Gradient of `loss` w.r.t. the un-normalized input of dual_forward.
+    Matches backpropagating through two separate normalize() calls bit for
+    bit: the clamp of InputNormalize passes everything through for inputs in
+    [0, 1], and the division by std is applied per network before the sum.
+    """
+    grad_g, grad_r = torch.autograd.grad(loss, [x_g, x_r])
+    return grad_g / normalize.new_std + grad_r / normalize.new_std
+
+
 def random_perturb(inputs, attack, eps):
     if attack == "inf":
         r_inputs = 2 * (torch.rand_like(inputs) - 0.5) * eps
@@ -204,6 +241,203 @@ def random_perturb(inputs, attack, eps):
     return r_inputs
 
 
+class TranslationStore(object):
+    """
+    Bounded store of the last translated image per (seed index, target class).
+    Images are kept as uint8 or half on `device`; when the store is full the
+    least recently used entries are evicted.
+    """
+
+    def __init__(
+        self, num_seeds, num_classes, capacity, shape, dtype="uint8", device="cpu"
+    ):
+        self.num_classes = num_classes
+        self.capacity = capacity
+        self.dtype = torch.uint8 if dtype == "uint8" else torch.half
+        self.images = torch.zeros(
+            (capacity,) + tuple(shape), dtype=self.dtype, device=device
+        )
+        self.slot_of = torch.full(
+            (num_seeds * num_classes,), -1, dtype=torch.long, device=device
+        )
+        self.key_of = torch.full((capacity,), -1, dtype=torch.long, device=device)
+        # 0 marks a slot that was never used, so free slots are taken first
+        self.last_used = torch.zeros(capacity, dtype=torch.long, device=device)
+        self.clock = 0
+
+    def keys(self, seed_index, targets):
+        return seed_index * self.num_classes + targets
+
+    def lookup(self, keys):
+        """Return the hit mask and the slots of `keys`, and mark hits as used."""
+        self.clock += 1
+        slots = self.slot_of[keys]
+        hit = slots >= 0
+        self.last_used[slots[hit]] = self.clock
+        return hit, slots
+
+    def get(self, slots):
+        images = self.images[slots].float()
+        if self.dtype == torch.uint8:
+            images = images.div_(255)
+        return images
+
+    def put(self, keys, images):
+        # The same key can appear twice in a batch; keep one image per key
+        keys, inverse = torch.unique(keys, return_inverse=True)
+        pos = torch.empty_like(keys).scatter_(
+            0, inverse, torch.arange(inverse.size(0), device=keys.device)
+        )
+        images = images[pos]
+
+        slots = self.slot_of[keys]
+        keep = slots >= 0
+        # Misses never take the slot of a key stored in this same batch
+        hit_slots = slots[keep]
+        miss = (~keep).nonzero().view(-1)[: self.capacity - hit_slots.size(0)]
+        if miss.size(0) > 0:
+            last_used = self.last_used.clone()
+            last_used[hit_slots] = self.clock + 1
+            new_slots = torch.topk(last_used, miss.size(0), largest=False)[1]
+            old_keys = self.key_of[new_slots]
+            self.slot_of[old_keys[old_keys >= 0]] = -1
+            self.key_of[new_slots] = keys[miss]
+            self.slot_of[keys[miss]] = new_slots
+            slots[miss] = new_slots
+            keep[miss] = True
+
+        slots, images = slots[keep], images[keep]
+        if self.dtype == torch.uint8:
+            images = images.mul(255).round_().clamp_(0, 255)
+        self.images[slots] = images.to(self.dtype)
+        self.last_used[slots] = self.clock
+
+
+def file_hash(path, length=16):
+    """Short sha1 of the content of a file, e.g. of a checkpoint."""
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()[:length]
+
+
+# Frozen checkpoints already loaded by this process, see load_checkpoint
+_CHECKPOINTS = {}
+
+
+def load_checkpoint(path):
+    """
+    torch.load a frozen checkpoint ( e.g. net_g ) once per process, so that
+    the runs of a sweep share it. Only read it, e.g. through load_state_dict.
+    """
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    if key not in _CHECKPOINTS:
+        _CHECKPOINTS[key] = torch.load(path)
+    return _CHECKPOINTS[key]
+
+
+class GenerationStore(object):
+    """
+    Translations exported once by `train.py --export_gen`, as memory-mapped
+    .npy files: uint8 images (N, C, H, W) with their target class, seed index
+    and seed class in the imbalanced split, the p_accept of the seed and the
+    g-confidence on the target class.
+    """
+
+    FIELDS = ["images", "targets", "seed_index", "seed_targets", "p_accept", "conf_g"]
+
+    def __init__(self, root, num_classes):
+        arrays = {
+            name: np.load(os.path.join(root, name + ".npy"), mmap_mode="r")
+            for name in self.FIELDS
+        }
+        # Images stay on disk; the small per-sample fields are loaded
+        self.images = arrays["images"]
+        self.targets = torch.from_numpy(np.array(arrays["targets"]))
+        self.seed_targets = torch.from_numpy(np.array(arrays["seed_targets"]))
+        self.p_accept = torch.from_numpy(np.array(arrays["p_accept"]))
+
+        # Records grouped by target class
+        self.counts = torch.bincount(self.targets, minlength=num_classes)
+        self.starts = torch.cumsum(self.counts, 0) - self.counts
+        self.order = torch.argsort(self.targets)
+
+    def __len__(self):
+        return self.targets.size(0)
+
+    @classmethod
+    def save(cls, root, records):
+        """Write `records` ( a dict of arrays over FIELDS ) to `root` at once."""
+        tmp_dir = "{}.tmp{}".format(root, os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name in cls.FIELDS:
+            np.save(os.path.join(tmp_dir, name + ".npy"), np.asarray(records[name]))
+        if os.path.exists(root):
+            shutil.rmtree(root)
+        os.rename(tmp_dir, root)
+
+    def sample(self, targets):
+        """
+        Draw a stored record uniformly for every target class. Returns the
+        mask of targets that have any record and the records of those.
+        """
+        targets = targets.cpu()
+        counts = self.counts[targets]
+        valid = counts > 0
+        offset = (torch.rand(targets.size(0)) * counts).long()
+        index = self.order[(self.starts[targets] + offset)[valid]]
+        return valid, index
+
+    def get(self, index):
+        """Return the images ( in [0, 1] ), seed classes and p_accept of records."""
+        index = index.numpy()
+        images = torch.from_numpy(self.images[index])
+        return (
+            images.float().div_(255),
+            self.seed_targets[index],
+            self.p_accept[index],
+        )
+
+
+######## Embeddings ########
+
+
+def save_embedding(embed, targets, path, method="pca", title=None):
+    """
+    Project per-class samples ( logits or features ) to 2-D with PCA, or
+    t-SNE with method="tsne", and save a scatter plot to `path`.
+    Meant to run in a worker process, hence the local imports.
+    """
+    import matplotlib
+
+    matplotlib.use("agg")
+    import matplotlib.pyplot as plt
+
+    if method == "tsne":
+        from sklearn.manifold import TSNE
+
+        points = TSNE(n_components=2, random_state=42).fit_transform(embed)
+    else:
+        from sklearn.decomposition import PCA
+
+        points = PCA(n_components=2).fit_transform(embed)
+
+    classes = np.unique(targets)
+    plt.figure(figsize=(10, 8))
+    for c in classes:
+        mask = targets == c
+        plt.scatter(points[mask, 0], points[mask, 1], s=8, label=f"Class {c}")
+    if len(classes) <= 20:
+        plt.legend()
+    plt.title(title or "%s of training set embeddings" % method.upper())
+    plt.grid(True)
+    plt.gca().axes.get_xaxis().set_visible(False)
+    plt.gca().axes.get_yaxis().set_visible(False)
+    plt.savefig(path)
+    plt.close()
+
+
 ######## Data ########
 
 